@@ -1,17 +1,22 @@
 import numpy as np
-from pure_recycler_loop import recycler_loop, recycler_matrix
+from typing import Union
+from pure_recycler_loop import recycler_loop, recycler_loop_batch, recycler_matrix
+from quality import QualityModel, DEFAULT_QUALITY_MODEL
 
 # Let's lean on the functions from pure_recycler_loop.py
 
-def asteroid_crusher_matrix(quality_chance : float) -> np.ndarray:
-    return recycler_matrix(quality_chance, production_ratio=0.8)
+def asteroid_crusher_matrix(quality_chance : float, model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    return recycler_matrix(quality_chance, production_ratio=0.8, model=model)
 
-def asteroid_crusher_loop(input_vector : float, quality_chance : float, quality_to_keep : int = 5) -> np.ndarray:
-    return recycler_loop(input_vector, quality_chance, quality_to_keep, production_ratio=0.8)
+def asteroid_crusher_loop(input_vector : float, quality_chance : float, quality_to_keep : Union[int, None] = None, iterative : bool = False, model : QualityModel = DEFAULT_QUALITY_MODEL, exact : bool = False) -> np.ndarray:
+    return recycler_loop(input_vector, quality_chance, quality_to_keep, production_ratio=0.8, iterative=iterative, model=model, exact=exact)
+
+def asteroid_crusher_loop_batch(input_vector : float, quality_chances : np.ndarray, quality_to_keep : Union[int, None] = None, model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    return recycler_loop_batch(input_vector, quality_chances, quality_to_keep, production_ratios=0.8, model=model)
 
 def normal_to_legendary_ratio():
     indices = list(range(1, 13)) + [12.4]
-    ratios = [float(1/asteroid_crusher_loop(1, i)[4]) for i in indices]
+    ratios = (1 / asteroid_crusher_loop_batch(1, indices)[:, 4]).tolist()
 
     print(f"{indices[4:]=}")
     print(f"{ratios[4:]=}")
@@ -20,10 +25,10 @@ def normal_to_legendary_ratio():
 def efficiency_data():
     indices = list(range(1, 13)) + [12.4]
 
-    uncommon  = [float(asteroid_crusher_loop(100, i, 2)[1]) for i in indices]
-    rare      = [float(asteroid_crusher_loop(100, i, 3)[2]) for i in indices]
-    epic      = [float(asteroid_crusher_loop(100, i, 4)[3]) for i in indices]
-    legendary = [float(asteroid_crusher_loop(100, i, 5)[4]) for i in indices]
+    uncommon  = asteroid_crusher_loop_batch(100, indices, 2)[:, 1].tolist()
+    rare      = asteroid_crusher_loop_batch(100, indices, 3)[:, 2].tolist()
+    epic      = asteroid_crusher_loop_batch(100, indices, 4)[:, 3].tolist()
+    legendary = asteroid_crusher_loop_batch(100, indices, 5)[:, 4].tolist()
 
     print(f"{uncommon=}")
     print(f"{rare=}")
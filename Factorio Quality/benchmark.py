@@ -0,0 +1,180 @@
+"""Benchmarks for the quality solvers.
+
+Times a set of representative workloads, and writes the results to a JSON file so that they can be compared between commits:
+
+    python benchmark.py                          # writes benchmark-<commit>.json
+    python benchmark.py --compare benchmark-abc1234.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Union
+
+import numpy as np
+
+from quality import custom_production_matrix
+from pure_recycler_loop import recycler_loop, recycler_loop_batch, recycler_loop_steps, recycler_matrix
+from recycler_assembler_loop import (
+    recycler_assembler_loop, recycler_assembler_transition_matrix, transition_matrix_steps, efficiency_table,
+    get_all_configs, optimal_modules_config, SystemOutput
+)
+
+def iterations_to_convergence(steps : Iterator[np.ndarray]) -> int:
+    "Returns the number of iterations the iterative solvers take before there's nothing left in the system."
+    return sum(1 for _ in steps) - 1 # The first step is the input
+
+def clear_caches():
+    "Clears the matrix caches, so that the workloads pay for building their matrices instead of measuring cache hits."
+    recycler_matrix.cache_clear()
+    custom_production_matrix.cache_clear()
+    recycler_assembler_transition_matrix.cache_clear()
+
+def measure(workload : Callable[[], object], repeat : int = 5, setup : Callable[[], object] = lambda: None) -> Dict[str, float]:
+    """Returns the best wall time (s) out of `repeat` runs of `workload`, and its peak memory usage (bytes).
+    `setup` is called before every run, e.g. to clear caches."""
+    times = []
+
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        workload()
+        times.append(time.perf_counter() - start)
+
+    setup()
+    tracemalloc.start()
+    workload()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds" : min(times), "peak_memory" : peak}
+
+def measure_import(module : str, repeat : int = 5) -> Dict[str, float]:
+    """Returns the best wall time (s) out of `repeat` imports of `module`, and its peak memory usage (bytes).
+    Every import runs in a fresh interpreter, so that nothing is cached in `sys.modules` yet."""
+    def run(code : str) -> str:
+        return subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+        ).stdout
+
+    times = [
+        float(run(f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"))
+        for _ in range(repeat)
+    ]
+    peak = int(run(f"import tracemalloc; tracemalloc.start(); import {module}; print(tracemalloc.get_traced_memory()[1])"))
+
+    return {"seconds" : min(times), "peak_memory" : peak}
+
+def run_benchmarks() -> Dict[str, Dict[str, Union[float, int]]]:
+    sweep = np.linspace(0.5, 24.8, 1000)
+    results = {}
+
+    # Startup cost
+    for module in ("quality", "pure_recycler_loop", "recycler_assembler_loop"):
+        results[f"import {module}"] = measure_import(module)
+
+    # Single evaluations, with cold caches: the matrices are built every time
+    results["recycler_loop"] = measure(lambda: recycler_loop(100, 24.8), 100, clear_caches)
+    results["recycler_loop (iterative)"] = measure(lambda: recycler_loop(100, 24.8, iterative=True), 20, clear_caches)
+    results["recycler_loop (iterative)"]["iterations"] = iterations_to_convergence(recycler_loop_steps(100, 24.8))
+
+    results["recycler_loop (accelerated)"] = measure(
+        lambda: recycler_loop(100, 24.8, iterative=True, accelerated=True), 20, clear_caches
+    )
+    results["recycler_loop (accelerated)"]["iterations"] = recycler_loop(
+        100, 24.8, iterative=True, accelerated=True, return_error_bound=True
+    )[2]
+
+    results["recycler_assembler_loop"] = measure(
+        lambda: recycler_assembler_loop(100, (0, 4), ingredients_quality_to_keep = None), 100, clear_caches
+    )
+    results["recycler_assembler_loop (iterative)"] = measure(
+        lambda: recycler_assembler_loop(100, (0, 4), ingredients_quality_to_keep = None, iterative=True), 20, clear_caches
+    )
+    results["recycler_assembler_loop (iterative)"]["iterations"] = iterations_to_convergence(transition_matrix_steps(
+        np.array([100] + [0] * 9), recycler_assembler_transition_matrix(((0, 4),) * 5, 5, None)
+    ))
+    results["recycler_assembler_loop (accelerated)"] = measure(
+        lambda: recycler_assembler_loop(100, (0, 4), ingredients_quality_to_keep = None, iterative=True, accelerated=True), 20, clear_caches
+    )
+    results["recycler_assembler_loop (accelerated)"]["iterations"] = recycler_assembler_loop(
+        100, (0, 4), ingredients_quality_to_keep = None, iterative=True, accelerated=True, return_error_bound=True
+    )[2]
+
+    # High productivity loop, which takes hundreds of steps to empty
+    results["high productivity loop (iterative)"] = measure(
+        lambda: recycler_assembler_loop(100, (8, 0), ingredients_quality_to_keep = None, base_prod_bonus=250, iterative=True), 20, clear_caches
+    )
+    results["high productivity loop (iterative)"]["iterations"] = iterations_to_convergence(transition_matrix_steps(
+        np.array([100] + [0] * 9), recycler_assembler_transition_matrix(((8, 0),) * 5, 5, None, 250)
+    ))
+    results["high productivity loop (accelerated)"] = measure(
+        lambda: recycler_assembler_loop(100, (8, 0), ingredients_quality_to_keep = None, base_prod_bonus=250, iterative=True, accelerated=True), 20, clear_caches
+    )
+    results["high productivity loop (accelerated)"]["iterations"] = recycler_assembler_loop(
+        100, (8, 0), ingredients_quality_to_keep = None, base_prod_bonus=250, iterative=True, accelerated=True, return_error_bound=True
+    )[2]
+
+    # 1000 point quality chance sweep
+    results["sweep 1000 (recycler_loop)"] = measure(lambda: [recycler_loop(100, q) for q in sweep], 3, clear_caches)
+    results["sweep 1000 (recycler_loop, iterative)"] = measure(lambda: [recycler_loop(100, q, iterative=True) for q in sweep], 1, clear_caches)
+    results["sweep 1000 (recycler_loop_batch)"] = measure(lambda: recycler_loop_batch(100, sweep), 10, clear_caches)
+
+    # Module configurations
+    results["get_all_configs(8)"] = measure(lambda: get_all_configs(8), 3)
+
+    for slots in range(2, 9):
+        for output in SystemOutput:
+            results[f"optimal_modules_config({slots}, {output.name})"] = measure(
+                lambda: optimal_modules_config(slots, 0, output), 3, clear_caches
+            )
+
+    with contextlib.redirect_stdout(io.StringIO()): # Don't print the table
+        results["efficiency_table"] = measure(
+            lambda: efficiency_table(use_cache=False), 3, clear_caches
+        )
+
+    return results
+
+def current_commit() -> Union[str, None]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results : Dict[str, Dict[str, Union[float, int]]], baseline : Union[Dict[str, Dict[str, Union[float, int]]], None] = None):
+    for name, result in results.items():
+        line = f"{name:<50} {result['seconds'] * 1000:>12.3f} ms {result['peak_memory'] / 1024:>10.1f} KiB"
+
+        if "iterations" in result:
+            line += f" {result['iterations']:>6} iterations"
+
+        if baseline is not None and name in baseline:
+            line += f"  ({result['seconds'] / baseline[name]['seconds']:.2f}x)"
+
+        print(line)
+
+def main(arguments : Union[List[str], None] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", type=Path, help="Where to write the results. Defaults to benchmark-<commit>.json")
+    parser.add_argument("--compare", type=Path, help="Results of a previous run to compare against")
+    args = parser.parse_args(arguments)
+
+    commit = current_commit()
+    results = run_benchmarks()
+
+    baseline = json.loads(args.compare.read_text())["results"] if args.compare else None
+    print_results(results, baseline)
+
+    output = args.output or Path(__file__).parent / f"benchmark-{commit or 'unknown'}.json"
+    output.write_text(json.dumps({"commit" : commit, "results" : results}, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import numpy as np
+from pathlib import Path
+from typing import Union
+
+from pure_recycler_loop import recycler_loop_batch
+
+# Precomputed results of `recycler_loop` for the base game, on a fine grid of
+# quality chance x production ratio x quality to keep, stored as a memory-mapped .npy file.
+# The axes of the grid are saved next to it, so that a table built for another grid is never used.
+# Bump the version whenever the model changes, so that a new table gets built.
+TABLE_VERSION = 2
+TABLE_PATH = Path(__file__).parent / f"recycler_loop_table_v{TABLE_VERSION}.npy"
+
+# The higher tiers grow like a power of the quality chance, so the quality chances are spaced evenly on a log scale.
+# The flows grow like a power of the production ratio near 0, and blow up near 1, so the production ratios are spaced
+# evenly on a logit scale, which is dense at both ends.
+QUALITY_CHANCES   = np.geomspace(0.1, 30, 300) # %
+PRODUCTION_RATIOS = 1 / (1 + np.exp(-np.linspace(np.log(0.001 / 0.999), np.log(0.999 / 0.001), 201)))
+QUALITIES_TO_KEEP = np.arange(1, 6)
+
+def logit(production_ratio : np.ndarray) -> np.ndarray:
+    return np.log(production_ratio / (1 - production_ratio))
+
+def axes_path(path : Path) -> Path:
+    "Returns the path of the file with the axes of the grid of the table saved in `path`."
+    return path.with_name(path.stem + "_axes.npz")
+
+def build_table(path : Path = TABLE_PATH) -> np.ndarray:
+    """Computes the lookup table and saves it to `path`.
+
+    Returns:
+        np.ndarray: (qualities to keep, quality chances, production ratios, 5) array with the result of
+            `recycler_loop(1, ...)` for every point of the grid.
+    """
+    quality_to_keep, quality_chances, production_ratios = np.meshgrid(
+        QUALITIES_TO_KEEP, QUALITY_CHANCES, PRODUCTION_RATIOS, indexing="ij"
+    )
+
+    table = recycler_loop_batch(1, quality_chances.ravel(), quality_to_keep.ravel(), production_ratios.ravel())
+    table = table.reshape(quality_to_keep.shape + (5,))
+
+    np.save(path, table)
+    np.savez(
+        axes_path(path),
+        quality_chances = QUALITY_CHANCES,
+        production_ratios = PRODUCTION_RATIOS,
+        qualities_to_keep = QUALITIES_TO_KEEP
+    )
+    return table
+
+def load_table(path : Path = TABLE_PATH) -> np.ndarray:
+    "Returns the lookup table (memory-mapped), building it first if it doesn't exist yet or if it was built for another grid."
+    if path.exists() and axes_path(path).exists():
+        with np.load(axes_path(path)) as axes:
+            same_grid = (
+                np.array_equal(axes["quality_chances"], QUALITY_CHANCES) and
+                np.array_equal(axes["production_ratios"], PRODUCTION_RATIOS) and
+                np.array_equal(axes["qualities_to_keep"], QUALITIES_TO_KEEP)
+            )
+
+        if same_grid:
+            return np.load(path, mmap_mode="r")
+
+    build_table(path)
+    return np.load(path, mmap_mode="r")
+
+_TABLE = None
+
+def lookup_recycler_loop(
+        input_amount : Union[np.ndarray, float],
+        quality_chance : Union[np.ndarray, float],
+        quality_to_keep : int = 5,
+        production_ratio : Union[np.ndarray, float] = 0.25) -> np.ndarray:
+    """Approximates `recycler_loop(input_amount, quality_chance, quality_to_keep, production_ratio)` by interpolating
+    the lookup table, without running any solver. Arrays of quality chances/production ratios are broadcast against each other.
+
+    The flows span several orders of magnitude, so the logarithm of the flows is interpolated bilinearly against the
+    logarithm of the quality chance and the logit of the production ratio (the scales the grid is even on). Flows that
+    are zero on some corner of the grid cell (the tiers that are kept) are interpolated linearly instead.
+    The relative error is below 0.1% everywhere on the grid. Queries outside of the grid are solved exactly.
+
+    Args:
+        input_amount (Union[np.ndarray, float]): Input rate of normal items going into the system.
+        quality_chance (Union[np.ndarray, float]): Quality chance of the recyclers (in %). The grid goes from 0.1 to 30.
+        quality_to_keep (int): Minimum quality level of the items to be removed from the system.
+        production_ratio (Union[np.ndarray, float]): Productivity ratio of the recyclers. The grid goes from 0.001 to 0.999.
+
+    Returns:
+        np.ndarray: Same as `recycler_loop`, with an extra leading dimension if arrays were passed.
+    """
+    global _TABLE
+    if _TABLE is None:
+        _TABLE = load_table()
+
+    assert type(quality_to_keep) == int and 1 <= quality_to_keep <= 5
+
+    quality_chance, production_ratio = np.broadcast_arrays(
+        np.asarray(quality_chance, dtype=float), np.asarray(production_ratio, dtype=float)
+    )
+    shape = quality_chance.shape
+    quality_chance, production_ratio = quality_chance.ravel(), production_ratio.ravel()
+
+    in_grid = (
+        (QUALITY_CHANCES[0] <= quality_chance) & (quality_chance <= QUALITY_CHANCES[-1]) &
+        (PRODUCTION_RATIOS[0] <= production_ratio) & (production_ratio <= PRODUCTION_RATIOS[-1])
+    )
+    res = np.empty((len(quality_chance), 5))
+
+    if not np.all(in_grid):
+        res[~in_grid] = recycler_loop_batch(1, quality_chance[~in_grid], quality_to_keep, production_ratio[~in_grid])
+
+    # Position of the queries on the grid
+    x = np.log(quality_chance[in_grid] / QUALITY_CHANCES[0]) / np.log(QUALITY_CHANCES[1] / QUALITY_CHANCES[0])
+    y = (logit(production_ratio[in_grid]) - logit(PRODUCTION_RATIOS[0])) / (logit(PRODUCTION_RATIOS[1]) - logit(PRODUCTION_RATIOS[0]))
+
+    x0 = np.clip(np.floor(x).astype(int), 0, len(QUALITY_CHANCES) - 2)
+    y0 = np.clip(np.floor(y).astype(int), 0, len(PRODUCTION_RATIOS) - 2)
+    tx = (x - x0)[..., None]
+    ty = (y - y0)[..., None]
+
+    table = _TABLE[quality_to_keep - 1]
+    corners = (table[x0, y0], table[x0 + 1, y0], table[x0, y0 + 1], table[x0 + 1, y0 + 1])
+    weights = ((1 - tx) * (1 - ty), tx * (1 - ty), (1 - tx) * ty, tx * ty)
+
+    positive = np.all([corner > 0 for corner in corners], axis=0)
+    linear = sum(corner * weight for corner, weight in zip(corners, weights))
+    logarithmic = np.exp(sum(np.log(np.where(positive, corner, 1)) * weight for corner, weight in zip(corners, weights)))
+
+    res[in_grid] = np.where(positive, logarithmic, linear)
+    res = res.reshape(shape + (5,))
+
+    return np.asarray(input_amount)[..., None] * res if np.ndim(input_amount) else input_amount * res
+
+def interpolation_error(samples : int = 10_000):
+    "Prints the worst relative error of the lookup table against `recycler_loop_batch`, on random points of the grid."
+    rng = np.random.default_rng(0)
+    quality_chances = np.exp(rng.uniform(np.log(QUALITY_CHANCES[0]), np.log(QUALITY_CHANCES[-1]), samples))
+    production_ratios = rng.uniform(PRODUCTION_RATIOS[0], PRODUCTION_RATIOS[-1], samples)
+
+    for quality_to_keep in range(2, 6):
+        exact = recycler_loop_batch(1, quality_chances, quality_to_keep, production_ratios)
+        approximation = lookup_recycler_loop(1, quality_chances, quality_to_keep, production_ratios)
+
+        relevant = exact > 1E-12
+        print(f"{quality_to_keep=}: {np.max(np.abs(approximation[relevant] / exact[relevant] - 1)):.2e}")
+
+if __name__ == "__main__":
+    interpolation_error()
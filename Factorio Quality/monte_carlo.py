@@ -0,0 +1,126 @@
+import numpy as np
+from typing import Union, List, Tuple
+
+from quality import spectral_radius, check_convergence, QualityModel, DEFAULT_QUALITY_MODEL
+from pure_recycler_loop import recycler_loop, recycler_matrix
+from recycler_assembler_loop import recycler_assembler_loop, recycler_assembler_transition_matrix, TOP_TIER
+
+def simulate_loop(
+        input_vector : np.ndarray,
+        transition_matrix : np.ndarray,
+        runs : int = 1000,
+        rng : Union[np.random.Generator, int, None] = None) -> np.ndarray:
+    """Simulates a loop craft by craft, instead of working with expected values.
+
+    Every item in state i goes through one craft, which makes `sum(T[i])` products on average: the whole part is
+    guaranteed, and the fractional part is a productivity roll. The quality of the craft is drawn once, with the
+    probabilities `T[i] / sum(T[i])`, and every product of that craft gets it, like in the game.
+    The draws are made for every craft of a given state at once (multinomial + binomial), for every run at once.
+
+    Args:
+        input_vector (np.ndarray): Number of items going into the loop, for each state.
+        transition_matrix (np.ndarray): Transition (or production) matrix T of the loop.
+        runs (int, optional): Number of independent simulations. Defaults to 1000.
+        rng (Union[np.random.Generator, int, None], optional): Random generator, or seed. Defaults to None (random seed).
+
+    Raises:
+        ValueError: If the loop doesn't converge.
+
+    Returns:
+        np.ndarray: (runs, states) array with the total number of items that went through each state, in every run.
+            Its average converges to `v @ inv(I - T)`.
+    """
+    check_convergence(spectral_radius(transition_matrix))
+
+    rng = np.random.default_rng(rng)
+    states = len(transition_matrix)
+
+    production_ratios = transition_matrix.sum(axis=1)
+    guaranteed = np.floor(production_ratios).astype(np.int64)
+
+    current = np.tile(np.asarray(input_vector, dtype=np.int64), (runs, 1))
+    total = current.copy()
+
+    while current.any():
+        following = np.zeros_like(current)
+
+        for state in range(states):
+            items = current[:, state]
+
+            if production_ratios[state] == 0 or not items.any():
+                # Nothing to process, or these items leave the loop
+                continue
+
+            # Number of crafts that land on every quality, and then the products those crafts make
+            crafts = rng.multinomial(items, transition_matrix[state] / production_ratios[state])
+            following += crafts * guaranteed[state] + rng.binomial(crafts, production_ratios[state] - guaranteed[state])
+
+        total += following
+        current = following
+
+    return total
+
+def simulate_recycler_loop(
+        items : int,
+        quality_chance : float,
+        quality_to_keep : Union[int, None] = None,
+        production_ratio : float = 0.25,
+        runs : int = 1000,
+        rng : Union[np.random.Generator, int, None] = None,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    """Simulates `runs` recycler loops, each fed `items` normal items. The other arguments mean the same as in `recycler_loop`.
+
+    Returns:
+        np.ndarray: (runs, tiers) array. Each line is what `recycler_loop(items, ...)` returns, for one simulation.
+    """
+    input_vector = np.zeros(model.tiers, dtype=np.int64)
+    input_vector[0] = items
+
+    return simulate_loop(input_vector, recycler_matrix(quality_chance, quality_to_keep, production_ratio, model), runs, rng)
+
+def simulate_recycler_assembler_loop(
+        ingredients : int,
+        assembler_modules_config : Union[Tuple[float, float], List[Tuple[float, float]]],
+        items_quality_to_keep : Union[int, None] = TOP_TIER,
+        ingredients_quality_to_keep : Union[int, None] = TOP_TIER,
+        base_prod_bonus : float = 0,
+        runs : int = 1000,
+        rng : Union[np.random.Generator, int, None] = None,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    """Simulates `runs` recycler/assembler loops, each fed `ingredients` normal ingredients.
+    The other arguments mean the same as in `recycler_assembler_loop`.
+
+    Returns:
+        np.ndarray: (runs, 2 * tiers) array. Each line is what `recycler_assembler_loop(ingredients, ...)` returns, for one simulation.
+    """
+    if type(assembler_modules_config) == tuple:
+        assembler_modules_config = [assembler_modules_config] * model.tiers
+
+    transition_matrix = recycler_assembler_transition_matrix(
+        tuple(tuple(modules) for modules in assembler_modules_config),
+        items_quality_to_keep,
+        ingredients_quality_to_keep,
+        base_prod_bonus,
+        model=model
+    )
+
+    input_vector = np.zeros(2 * model.tiers, dtype=np.int64)
+    input_vector[0] = ingredients
+
+    return simulate_loop(input_vector, transition_matrix, runs, rng)
+
+def validate_against_expected_values():
+    "Compares the average of the simulations with the expected values of the matrix models."
+    simulations = simulate_recycler_loop(10_000, 24.8, runs=2000, rng=0)
+    print("Recycler loop")
+    print(f"Simulated: {simulations.mean(axis=0)} ± {simulations.std(axis=0)}")
+    print(f"Expected:  {recycler_loop(10_000, 24.8)}")
+
+    simulations = simulate_recycler_assembler_loop(10_000, (0, 4), ingredients_quality_to_keep = None, runs=2000, rng=0)
+    print("Recycler/assembler loop")
+    print(f"Simulated: {simulations.mean(axis=0)} ± {simulations.std(axis=0)}")
+    print(f"Expected:  {recycler_assembler_loop(10_000, (0, 4), ingredients_quality_to_keep = None)}")
+
+if __name__ == "__main__":
+    np.set_printoptions(suppress=True, linewidth = 1000, precision = 2)
+    validate_against_expected_values()
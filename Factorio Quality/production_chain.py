@@ -0,0 +1,148 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+from typing import Union, List, Tuple, Dict, Iterable
+
+from quality import custom_production_matrix, check_convergence, QualityModel, DEFAULT_QUALITY_MODEL
+
+def sparse_spectral_radius(transition_matrix : scipy.sparse.spmatrix) -> float:
+    "Returns the spectral radius of a sparse `transition_matrix`. If it's 1 or above, the items in the chain grow forever."
+    if transition_matrix.shape[0] <= 500:
+        # eigs can't compute every eigenvalue, and small matrices are cheap to solve densely anyway
+        return float(max(abs(np.linalg.eigvals(transition_matrix.toarray())), default=0))
+
+    eigenvalues = scipy.sparse.linalg.eigs(transition_matrix.astype(float), k=1, which="LM", return_eigenvectors=False)
+    return float(abs(eigenvalues[0]))
+
+class ProductionChain:
+    """A graph of machines (assemblers, recyclers, crushers...) connected by item flows.
+
+    Every machine carries a production matrix built by `custom_production_matrix`: it turns the items going into it
+    into products of every quality. The products of a machine are either sent to other machines (flows) or leave the
+    chain as its output. The whole chain is assembled into a single sparse block matrix and solved in one go.
+    """
+
+    def __init__(self, model : QualityModel = DEFAULT_QUALITY_MODEL):
+        self.model = model
+        self.machines : Dict[str, np.ndarray] = {}
+        self.flows : List[Tuple[str, str, np.ndarray]] = []
+
+    def add_machine(self, name : str, parameters_per_row : List[Tuple[float, float]]) -> str:
+        """Adds a machine to the chain.
+
+        Args:
+            name (str): Unique name of the machine.
+            parameters_per_row (List[Tuple[float, float]]): Quality chance (%) and production ratio of the machine,
+                for every quality tier of its ingredients (see `custom_production_matrix`).
+
+        Returns:
+            str: The name of the machine, for convenience.
+        """
+        assert name not in self.machines
+
+        self.machines[name] = custom_production_matrix(parameters_per_row, self.model)
+        return name
+
+    def add_flow(self, source : str, target : str, tiers : Union[Iterable[int], None] = None):
+        """Sends the products of `source` to `target`.
+
+        Args:
+            source (str): Name of the machine that makes the products.
+            target (str): Name of the machine that consumes them.
+            tiers (Union[Iterable[int], None], optional): Quality tiers of the products that are sent (0 is normal).
+                Defaults to None (every tier). The tiers that aren't sent anywhere leave the chain.
+        """
+        assert source in self.machines and target in self.machines
+
+        mask = np.zeros(self.model.tiers)
+        mask[list(tiers) if tiers is not None else slice(None)] = 1
+
+        # Every product can only go to one place
+        for other_source, _, other_mask in self.flows:
+            if other_source == source:
+                assert not np.any(mask * other_mask)
+
+        self.flows.append((source, target, mask))
+
+    def transition_matrix(self) -> scipy.sparse.csr_matrix:
+        """Returns the transition matrix of the whole chain: block (a, b) is the production matrix of machine `a`,
+        restricted to the tiers that flow into machine `b`. Machines are laid out in the order they were added."""
+        tiers = self.model.tiers
+        index = {name : i for i, name in enumerate(self.machines)}
+        blocks = [[None] * len(index) for _ in index]
+
+        for source, target, mask in self.flows:
+            block = scipy.sparse.csr_matrix(self.machines[source] * mask)
+            a, b = index[source], index[target]
+            blocks[a][b] = block if blocks[a][b] is None else blocks[a][b] + block
+
+        # bmat needs a block in every block row and column: machines that receive or send nothing get empty ones
+        for i in range(len(index)):
+            if blocks[i][i] is None:
+                blocks[i][i] = scipy.sparse.csr_matrix((tiers, tiers))
+
+        return scipy.sparse.bmat(blocks, format="csr")
+
+    def solve(self, inputs : Dict[str, Union[np.ndarray, float]]) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """Calculates the steady state of the chain.
+
+        Args:
+            inputs (Dict[str, Union[np.ndarray, float]]): Flow rate of the items fed into each machine from outside the chain.
+                If a single value is passed, it is assumed to be the input rate of normal quality items.
+
+        Raises:
+            ValueError: If the chain never reaches a steady state, i.e. the amount of items grows forever.
+
+        Returns:
+            Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]: The total flow of items going into each machine,
+                and the flow of products of each machine that leave the chain.
+        """
+        tiers = self.model.tiers
+        names = list(self.machines)
+
+        input_vector = np.zeros(tiers * len(names))
+        for name, flow in inputs.items():
+            i = names.index(name)
+            input_vector[i * tiers : (i + 1) * tiers] = [flow] + [0] * (tiers - 1) if type(flow) in (float, int) else flow
+
+        transition_matrix = self.transition_matrix()
+
+        check_convergence(sparse_spectral_radius(transition_matrix))
+
+        # The total flow is v + vT + vT^2 + ... = v @ inv(I - T)
+        system = scipy.sparse.identity(len(input_vector), format="csr") - transition_matrix.T
+        flows = np.atleast_1d(scipy.sparse.linalg.spsolve(system.tocsc(), input_vector))
+
+        machine_flows = {name : flows[i * tiers : (i + 1) * tiers] for i, name in enumerate(names)}
+
+        outputs = {}
+        for name in names:
+            leaving = np.ones(tiers)
+            for source, _, mask in self.flows:
+                if source == name:
+                    leaving -= mask
+
+            outputs[name] = (machine_flows[name] @ self.machines[name]) * leaving
+
+        return machine_flows, outputs
+
+def recycler_assembler_chain_repro():
+    "Rebuilds the recycler/assembler loop from recycler_assembler_loop.py as a production chain."
+    from recycler_assembler_loop import recycler_assembler_loop
+
+    chain = ProductionChain()
+    chain.add_machine("assembler", [(2 * 6.2, 1.5)] * 5)
+    chain.add_machine("recycler", [(4 * 6.2, 0.25)] * 5)
+
+    chain.add_flow("assembler", "recycler", range(4)) # Legendary items leave the system
+    chain.add_flow("recycler", "assembler")
+
+    flows, outputs = chain.solve({"assembler" : 100})
+
+    print(flows)
+    print(outputs)
+    print(recycler_assembler_loop(100, (2, 2), ingredients_quality_to_keep = None))
+
+if __name__ == "__main__":
+    np.set_printoptions(suppress=True, linewidth = 1000)
+    recycler_assembler_chain_repro()
@@ -1,38 +1,57 @@
-from quality import custom_production_matrix
+from quality import (
+    custom_production_matrix, custom_production_matrices, production_matrix_derivatives, steady_state_derivatives,
+    doubling_steady_state, exact_steady_state, matrix_cache, spectral_radius, check_convergence, QualityModel, DEFAULT_QUALITY_MODEL
+)
 import numpy as np
-from functools import lru_cache
-from typing import Union
+from typing import Union, Tuple, Iterator
 
-@lru_cache()
-def recycler_matrix(quality_chance : float, quality_to_keep : int = 5, production_ratio : float = 0.25) -> np.ndarray:
-    """Returns a matrix of a recycler with quality chance `quality_chance`
+@matrix_cache()
+def recycler_matrix(
+        quality_chance : float,
+        quality_to_keep : Union[int, None] = None,
+        production_ratio : float = 0.25,
+        model : QualityModel = DEFAULT_QUALITY_MODEL,
+        exact : bool = False) -> np.ndarray:
+    """Returns the (cached, read-only) matrix of a recycler with quality chance `quality_chance`
     that saves any item of quality level `quality_to_keep` or above.
 
     Args:
         quality_chance (float): Quality chance of the recyclers (in %).
-        quality_to_keep (int): Minimum quality level of the items to be removed from the system
-            (By default only removes legendaries).
+        quality_to_keep (Union[int, None]): Minimum quality level of the items to be removed from the system
+            (By default only removes legendaries, i.e. the top tier of the model).
         production_ratio (float): Productivity ratio of the recyclers (0.25 by default)
+        model (QualityModel): Quality model (the base game's by default).
+        exact (bool): If True, the matrix is made of `Fraction`s (see `custom_production_matrix`).
 
     Returns:
         np.ndarray: Standard production matrix.
     """
+    if quality_to_keep is None:
+        quality_to_keep = model.tiers
+
     assert quality_chance > 0
-    assert type(quality_to_keep) == int and 1 <= quality_to_keep <= 5
+    assert type(quality_to_keep) == int and 1 <= quality_to_keep <= model.tiers
     assert production_ratio >= 0
 
     recycling_rows = quality_to_keep - 1
-    saving_rows = 5 - recycling_rows
+    saving_rows = model.tiers - recycling_rows
 
     return custom_production_matrix(
-        [(quality_chance, production_ratio)] * recycling_rows + [(0, 0)] * saving_rows
+        [(quality_chance, production_ratio)] * recycling_rows + [(0, 0)] * saving_rows,
+        model,
+        exact
     )
 
 def recycler_loop(
         input_vector : Union[np.array, float],
         quality_chance : float,
-        quality_to_keep : int = 5,
-        production_ratio : float = 0.25) -> np.ndarray:
+        quality_to_keep : Union[int, None] = None,
+        production_ratio : float = 0.25,
+        iterative : bool = False,
+        accelerated : bool = False,
+        model : QualityModel = DEFAULT_QUALITY_MODEL,
+        exact : bool = False,
+        return_error_bound : bool = False) -> Union[np.ndarray, Tuple[np.ndarray, float, int]]:
     """Returns a vector with values for each quality level that mean different things,
     depending on whether that quality is kept or recycled:
         - If the quality is kept: the value is the production rate of items of that quality level.
@@ -42,26 +61,183 @@ def recycler_loop(
         input_vector (np.array): The flow rate of items going into the system. If a single value is passed, 
             it is assumed to be the input rate of Q1 items going into the system.
         quality_chance (float): Quality chance of the recycler loop (in %).
-        quality_to_keep (int): Minimum quality level of the items to be removed from the system
-            (By default only removes legendaries).
+        quality_to_keep (Union[int, None]): Minimum quality level of the items to be removed from the system
+            (By default only removes legendaries, i.e. the top tier of the model).
+        production_ratio (float): Productivity ratio of the recyclers (0.25 by default)
+        iterative (bool): If True, simulate the loop step by step until there's nothing left in the system
+            instead of solving it directly. Useful to cross-check the closed-form solution.
+        accelerated (bool): If True (and `iterative` is True), sum the steps by repeated squaring (see `doubling_steady_state`)
+            instead of one step at a time.
+        model (QualityModel): Quality model (the base game's by default).
+        exact (bool): If True, solve the loop with rational arithmetic (see `exact_steady_state`): the result is a vector
+            of `Fraction`s with no rounding error at all. Floats in the arguments are read as the decimals they are written as.
+            Much slower than the default float64 solve, and can't be combined with `iterative`.
+        return_error_bound (bool): If True (only with `iterative` and `accelerated`), also return the error bound of the
+            flows and the number of doublings it took, as `doubling_steady_state` does.
+
+    Raises:
+        ValueError: If the loop never empties (e.g. a production ratio of 1 or above), i.e. the amount of items grows forever.
 
     Returns:
         np.ndarray: Vector with values for each quality level.
+            With `return_error_bound`, a tuple with that vector, its error bound and the number of doublings.
     """
+    assert not return_error_bound or (iterative and accelerated)
+
     if type(input_vector) in (float, int):
-        input_vector = np.array([input_vector, 0, 0, 0, 0])
-    
-    result_flows = [input_vector]
+        input_vector = np.array([input_vector] + [0] * (model.tiers - 1))
+
+    matrix = recycler_matrix(quality_chance, quality_to_keep, production_ratio, model)
+    check_convergence(spectral_radius(matrix))
+
+    if exact:
+        assert not iterative
+        return exact_steady_state(input_vector, recycler_matrix(quality_chance, quality_to_keep, production_ratio, model, exact=True))
+
+    if not iterative:
+        # The total flow is v + vM + vM^2 + ... = v @ inv(I - M)
+        return np.linalg.solve(np.eye(model.tiers) - matrix.T, input_vector)
+
+    if accelerated:
+        flows, error_bound, doublings = doubling_steady_state(input_vector, matrix)
+        return (flows, error_bound, doublings) if return_error_bound else flows
+
+    return sum(recycler_loop_steps(input_vector, quality_chance, quality_to_keep, production_ratio, model))
+
+def recycler_loop_steps(
+        input_vector : Union[np.array, float],
+        quality_chance : float,
+        quality_to_keep : Union[int, None] = None,
+        production_ratio : float = 0.25,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> Iterator[np.ndarray]:
+    """Yields the flows of the recycler loop at every step, starting with `input_vector`, until there's nothing left
+    in the system. The arguments mean the same as in `recycler_loop`, and the sum of every step is its result.
+    Only the current step is kept in memory.
+    """
+    if type(input_vector) in (float, int):
+        input_vector = np.array([input_vector] + [0] * (model.tiers - 1))
+
+    matrix = recycler_matrix(quality_chance, quality_to_keep, production_ratio, model)
+
+    flow = input_vector
+    yield flow
+
     while True:
-        result_flows.append(
-            result_flows[-1] @ recycler_matrix(quality_chance, quality_to_keep, production_ratio)
-        )
+        next_flow = flow @ matrix
+        yield next_flow
 
-        if sum(result_flows[-2] - result_flows[-1]) < 1E-10:
+        if sum(flow - next_flow) < 1E-10:
             # There's nothing left in the system
             break
 
-    return sum(result_flows)
+        flow = next_flow
+
+def recycler_loop_sensitivity(
+        input_vector : Union[np.array, float],
+        quality_chance : float,
+        quality_to_keep : Union[int, None] = None,
+        production_ratio : float = 0.25,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Same as `recycler_loop`, but also returns the derivatives of the result with respect to the quality chance
+    and production ratio of the recyclers of every quality level. The quality levels that are kept have their
+    parameters set to (0, 0), so their derivatives tell what would happen if you started recycling them.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The result of `recycler_loop`, and two (tiers, tiers) arrays where the
+            element [i, k] is the derivative of the result's value k with respect to the quality chance (%)/production ratio
+            of the recyclers of quality level i + 1. E.g. `[:, 4]` is the gradient of the legendary output.
+    """
+    if quality_to_keep is None:
+        quality_to_keep = model.tiers
+
+    flows = recycler_loop(input_vector, quality_chance, quality_to_keep, production_ratio, model=model)
+
+    recycling_rows = quality_to_keep - 1
+    parameters = [(quality_chance, production_ratio)] * recycling_rows + [(0, 0)] * (model.tiers - recycling_rows)
+    d_quality_chances, d_production_ratios = production_matrix_derivatives(parameters, model)
+
+    matrix = recycler_matrix(quality_chance, quality_to_keep, production_ratio, model)
+
+    return (
+        flows,
+        steady_state_derivatives(flows, matrix, d_quality_chances),
+        steady_state_derivatives(flows, matrix, d_production_ratios)
+    )
+
+def recycler_matrices(
+        quality_chances : Union[np.ndarray, float],
+        quality_to_keep : Union[np.ndarray, int, None] = None,
+        production_ratios : Union[np.ndarray, float] = 0.25,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    """Batched version of `recycler_matrix`. The arguments are broadcast against each other.
+
+    Args:
+        quality_chances (Union[np.ndarray, float]): Quality chances of the recyclers (in %).
+        quality_to_keep (Union[np.ndarray, int, None]): Minimum quality levels of the items to be removed from the system.
+            Defaults to the top tier of the model.
+        production_ratios (Union[np.ndarray, float]): Productivity ratios of the recyclers.
+        model (QualityModel): Quality model (the base game's by default).
+
+    Returns:
+        np.ndarray: (N, tiers, tiers) stack of production matrices.
+    """
+    if quality_to_keep is None:
+        quality_to_keep = model.tiers
+
+    quality_chances, quality_to_keep, production_ratios = np.broadcast_arrays(
+        np.atleast_1d(quality_chances), np.atleast_1d(quality_to_keep), np.atleast_1d(production_ratios)
+    )
+
+    assert np.all(quality_chances > 0)
+    assert np.all((1 <= quality_to_keep) & (quality_to_keep <= model.tiers))
+    assert np.all(production_ratios >= 0)
+
+    # Same layout as recycler_matrix: the rows of the saved qualities are (0, 0)
+    recycling_rows = np.arange(model.tiers) < (quality_to_keep - 1)[:, None]
+
+    return custom_production_matrices(
+        recycling_rows * quality_chances[:, None],
+        recycling_rows * production_ratios[:, None],
+        model
+    )
+
+def recycler_loop_batch(
+        input_vector : Union[np.ndarray, float],
+        quality_chances : Union[np.ndarray, float],
+        quality_to_keep : Union[np.ndarray, int, None] = None,
+        production_ratios : Union[np.ndarray, float] = 0.25,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    """Batched version of `recycler_loop`: evaluates many recycler loops with a single linear solve.
+    The quality chances, qualities to keep and production ratios are broadcast against each other.
+
+    Args:
+        input_vector (Union[np.ndarray, float]): The flow rate of items going into the system. Can be a single value
+            (input rate of Q1 items), a vector of 5 values shared by every loop, or a (N, 5) array with one vector per loop
+            (one value per tier of the model).
+        quality_chances (Union[np.ndarray, float]): Quality chances of the recycler loops (in %).
+        quality_to_keep (Union[np.ndarray, int, None]): Minimum quality levels of the items to be removed from the system.
+            Defaults to the top tier of the model.
+        production_ratios (Union[np.ndarray, float]): Productivity ratios of the recyclers.
+        model (QualityModel): Quality model (the base game's by default).
+
+    Raises:
+        ValueError: If any of the loops never empties.
+
+    Returns:
+        np.ndarray: (N, tiers) array where each line is what `recycler_loop` would return for that set of parameters.
+    """
+    matrices = recycler_matrices(quality_chances, quality_to_keep, production_ratios, model)
+
+    # Items only go up in quality, so the matrices are triangular and their eigenvalues are their diagonals
+    check_convergence(np.abs(np.diagonal(matrices, axis1=1, axis2=2)).max(initial=0))
+
+    if type(input_vector) in (float, int):
+        input_vector = np.array([input_vector] + [0] * (model.tiers - 1))
+    input_vector = np.broadcast_to(input_vector, (len(matrices), model.tiers))
+
+    # Same as recycler_loop, but over the whole (N, tiers, tiers) stack at once
+    systems = np.eye(model.tiers) - matrices.transpose(0, 2, 1)
+    return np.linalg.solve(systems, input_vector[:, :, None])[:, :, 0]
 
 
 def bmatrix(a): # https://stackoverflow.com/questions/17129290/numpy-2d-and-1d-array-to-latex-bmatrix
@@ -80,7 +256,7 @@ def bmatrix(a): # https://stackoverflow.com/questions/17129290/numpy-2d-and-1d-a
 
 def normal_to_legendary_ratio():
     indices = list(range(1, 25)) + [24.8]
-    ratios = [float(1/recycler_loop(1, i)[4]) for i in indices]
+    ratios = (1 / recycler_loop_batch(1, indices)[:, 4]).tolist()
 
     print(f"{indices[9:]=}")
     print(f"{ratios[9:]=}")
@@ -88,10 +264,10 @@ def normal_to_legendary_ratio():
 def efficiency_data():
     indices = list(range(1, 25)) + [24.8]
 
-    uncommon  = [float(recycler_loop(100, i, 2)[1]) for i in indices]
-    rare      = [float(recycler_loop(100, i, 3)[2]) for i in indices]
-    epic      = [float(recycler_loop(100, i, 4)[3]) for i in indices]
-    legendary = [float(recycler_loop(100, i, 5)[4]) for i in indices]
+    uncommon  = recycler_loop_batch(100, indices, 2)[:, 1].tolist()
+    rare      = recycler_loop_batch(100, indices, 3)[:, 2].tolist()
+    epic      = recycler_loop_batch(100, indices, 4)[:, 3].tolist()
+    legendary = recycler_loop_batch(100, indices, 5)[:, 4].tolist()
 
     print(f"{uncommon=}")
     print(f"{rare=}")
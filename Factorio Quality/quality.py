@@ -1,7 +1,11 @@
 import numpy as np
 
+from collections import OrderedDict
 from enum import IntEnum
-from typing import Union, List, Tuple
+from fractions import Fraction
+from functools import wraps
+from inspect import signature
+from typing import Union, List, Tuple, Callable, NamedTuple
 
 class QualityTier(IntEnum):
     Normal    = 0
@@ -11,7 +15,43 @@ class QualityTier(IntEnum):
     Legendary = 4
 
 
-def quality_probability(quality_chance : float, input_tier : QualityTier, output_tier : QualityTier) -> float:
+class QualityModel:
+    """Describes the quality mechanics of the game: how many quality tiers there are, and how much less likely
+    it is for an item to skip each additional tier when it gets upgraded (`decay`).
+
+    The default model (`DEFAULT_QUALITY_MODEL`) is the one from the base game: 5 tiers, each skip being 10x less likely.
+    Models are meant to be treated as immutable: they are hashable, so they can be used as cache keys.
+    """
+
+    def __init__(self, tiers : int = 5, decay : float = 10):
+        assert type(tiers) == int and tiers >= 2
+        assert decay > 1
+
+        self.tiers = tiers
+        self.decay = float(decay)
+        self._hash = hash((self.tiers, self.decay)) # Models are used as cache keys all the time
+
+        # Every probability returned by `quality_probability` is affine in the quality chance:
+        # `identity + quality_chance/100 * coefficient`. This is the (tiers x tiers) matrix of those coefficients.
+        self.upgrade_coefficients = np.zeros((tiers, tiers))
+
+        for row in range(tiers):
+            for column in range(tiers):
+                self.upgrade_coefficients[row][column] = quality_probability(100, row, column, self) - (row == column)
+
+        self.upgrade_coefficients.setflags(write=False)
+
+    def __eq__(self, other):
+        return isinstance(other, QualityModel) and (self.tiers, self.decay) == (other.tiers, other.decay)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"QualityModel(tiers={self.tiers}, decay={self.decay})"
+
+
+def quality_probability(quality_chance : float, input_tier : QualityTier, output_tier : QualityTier, model : Union[QualityModel, None] = None) -> float:
     """Calculates the probability of a machine craft with a certain `quality_chance` upgrading 
     the resulting product from the tier of the products (`input_tier`) to the `output_tier`.
 
@@ -19,27 +59,31 @@ def quality_probability(quality_chance : float, input_tier : QualityTier, output
         quality_chance (float): Quality chance (in %).
         input_tier (QualityTier): Quality tier of the ingredients.
         output_tier (QualityTier): Quality tier of the product.
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
     
     Returns:
         float: A probability from 0 to 1.
     """
-    
+    model = model if model is not None else DEFAULT_QUALITY_MODEL
+    top_tier = model.tiers - 1
+
     # Basic validations
     assert 0 <= quality_chance <= 100
-    assert 0 <= input_tier  <= 4 and type(input_tier)  == int
-    assert 0 <= output_tier <= 4 and type(output_tier) == int
+    assert 0 <= input_tier  <= top_tier and type(input_tier)  == int
+    assert 0 <= output_tier <= top_tier and type(output_tier) == int
 
     # Some QoL conversions
     quality_chance /= 100
     i = input_tier
     o = output_tier
+    d = exact_fraction(model.decay) if type(quality_chance) == Fraction else model.decay # Stay exact in exact mode
 
     # An item can never be downgraded
     if input_tier > output_tier:
         return 0
     
     # If the item is already legendary, it will remain legendary
-    if input_tier == QualityTier.Legendary:
+    if input_tier == top_tier:
         return 1
     
     # Probability of item staying in the same tier
@@ -47,65 +91,350 @@ def quality_probability(quality_chance : float, input_tier : QualityTier, output
         return 1 - quality_chance
     
     # Probability of item going straight to legendary
-    if output_tier == QualityTier.Legendary:
-        return quality_chance / (10 ** (3 - i))
+    if output_tier == top_tier:
+        return quality_chance / (d ** (top_tier - 1 - i))
     
     # else
-    return (quality_chance * 9/10) / (10 ** (o - i - 1))
+    return (quality_chance * (1 - 1/d)) / (d ** (o - i - 1))
+
+
+DEFAULT_QUALITY_MODEL = QualityModel()
+
+
+def exact_fraction(value : Union[float, int, Fraction]) -> Fraction:
+    """Converts `value` to a `Fraction`. Floats are read as the decimal number they are written as,
+    so `6.2` becomes `31/5` instead of the binary approximation `6980579422424269/1125899906842624`."""
+    if type(value) == Fraction:
+        return value
+    if isinstance(value, (int, np.integer)):
+        return Fraction(int(value))
+    return Fraction(str(float(value)))
+
+
+class MatrixCacheInfo(NamedTuple):
+    hits : int
+    misses : int
+    maxsize : int
+    currsize : int
+
+def matrix_cache(maxsize : int = 1024, decimals : int = 9) -> Callable:
+    """Decorator that caches the matrices returned by a matrix builder, like `functools.lru_cache`, but safer for sweeps:
+
+    - The cached matrices are read-only, so a caller can't corrupt the cache by modifying one of them.
+    - Float arguments are rounded to `decimals` decimal places before being used as keys, so values that only differ
+      by floating point noise (e.g. `0.1 + 0.2` and `0.3`) share the same matrix. Calls with `exact=True` are never
+      rounded, since their whole point is to tell those values apart.
+    - Only the `maxsize` most recently used matrices are kept. The bound can be changed with `set_maxsize`.
+
+    Like with `lru_cache`, the decorated function gets `cache_info()` and `cache_clear()` methods.
+
+    Args:
+        maxsize (int, optional): Maximum number of matrices to keep. Defaults to 1024.
+        decimals (int, optional): Number of decimal places float arguments are rounded to. Defaults to 9.
+    """
+    assert type(maxsize) == int and maxsize > 0
+
+    def quantize(argument, exact : bool = False):
+        if isinstance(argument, (float, np.floating)):
+            return float(argument) if exact else round(float(argument), decimals)
+        if isinstance(argument, (list, tuple)):
+            return tuple(quantize(element, exact) for element in argument)
+        return argument
+
+    def decorator(function : Callable[..., np.ndarray]) -> Callable[..., np.ndarray]:
+        cache = OrderedDict()
+        stats = {"hits" : 0, "misses" : 0, "maxsize" : maxsize}
+
+        # Position of the `exact` argument of the builder, if it has one
+        parameters = list(signature(function).parameters)
+        exact_position = parameters.index("exact") if "exact" in parameters else None
 
+        @wraps(function)
+        def wrapper(*args, **kwargs) -> np.ndarray:
+            exact = exact_position is not None and bool(
+                kwargs["exact"] if "exact" in kwargs else len(args) > exact_position and args[exact_position]
+            )
+            key = (quantize(args, exact), tuple((name, quantize(value, exact)) for name, value in kwargs.items()))
 
-def quality_matrix(quality_chance : float) -> np.ndarray:
-    """Returns the quality matrix for the corresponding `quality_chance` which indicates 
+            if key in cache:
+                stats["hits"] += 1
+                cache.move_to_end(key)
+                return cache[key]
+
+            stats["misses"] += 1
+            res = np.array(function(*args, **kwargs))
+            res.setflags(write=False)
+
+            cache[key] = res
+            if len(cache) > stats["maxsize"]:
+                cache.popitem(last=False)
+
+            return res
+
+        def cache_info() -> MatrixCacheInfo:
+            return MatrixCacheInfo(stats["hits"], stats["misses"], stats["maxsize"], len(cache))
+
+        def cache_clear():
+            cache.clear()
+            stats["hits"] = stats["misses"] = 0
+
+        def set_maxsize(new_maxsize : int):
+            assert type(new_maxsize) == int and new_maxsize > 0
+
+            stats["maxsize"] = new_maxsize
+            while len(cache) > new_maxsize:
+                cache.popitem(last=False)
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        wrapper.set_maxsize = set_maxsize
+
+        return wrapper
+
+    return decorator
+
+
+def quality_probabilities(
+        quality_chances : Union[np.ndarray, float],
+        production_ratios : Union[np.ndarray, float] = 1,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    """Array-native version of `quality_probability`: calculates the probabilities of every input tier jumping
+    to every output tier, for a whole batch of machines at once.
+
+    Args:
+        quality_chances (Union[np.ndarray, float]): Quality chances (in %). Either one value per matrix (shape (N,))
+            or one value per row of each matrix (shape (N, tiers)).
+        production_ratios (Union[np.ndarray, float], optional): Production ratios, with the same shape rules as
+            `quality_chances`. Defaults to 1, which yields plain quality matrices.
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
+
+    Returns:
+        np.ndarray: (N, tiers, tiers) stack of matrices, laid out like `quality_matrix`.
+    """
+    quality_chances   = np.asarray(quality_chances, dtype=float)
+    production_ratios = np.asarray(production_ratios, dtype=float)
+
+    # Basic validations
+    assert np.all((0 <= quality_chances) & (quality_chances <= 100))
+
+    # Promote everything to one value per row: (N, tiers)
+    if quality_chances.ndim < 2:
+        quality_chances = np.repeat(np.atleast_1d(quality_chances)[:, None], model.tiers, axis=1)
+    if production_ratios.ndim < 2:
+        production_ratios = np.repeat(np.atleast_1d(production_ratios)[:, None], model.tiers, axis=1)
+    quality_chances, production_ratios = np.broadcast_arrays(quality_chances, production_ratios)
+
+    assert quality_chances.shape[-1] == model.tiers
+
+    res = np.eye(model.tiers) + (quality_chances / 100)[:, :, None] * model.upgrade_coefficients
+
+    return res * production_ratios[:, :, None]
+
+
+@matrix_cache()
+def quality_matrix(quality_chance : float, model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    """Returns the (cached, read-only) quality matrix for the corresponding `quality_chance` which indicates 
     the probabilities of any input tier jumping to any other tier.
 
     Args:
         quality_chance (float): Quality chance (in %).
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
 
     Returns:
-        np.ndarray: 5x5 matrix. The columns represent the input quality tier and go from legendary to normal, from left to right.
+        np.ndarray: 5x5 matrix (tiers x tiers for other models). The columns represent the input quality tier and go from legendary to normal, from left to right.
             The lines represent the output quality tier and go from normal to legendary, from top to bottom.
     """
-
-    res = np.zeros((5,5))
-    
-    for row in range(5):
-        for column in range(5):
-            res[row][column] = quality_probability(quality_chance, row, column)
-    
-    return res
+    return quality_probabilities(quality_chance, model=model)[0]
 
 
-def basic_production_matrix(quality_chance : float, production_ratio : float = 1) -> np.ndarray:
-    "Returns the production matrix for the corresponding `quality_chance` and `production_ratio`."
-    return quality_matrix(quality_chance) * production_ratio
+@matrix_cache()
+def basic_production_matrix(quality_chance : float, production_ratio : float = 1, model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    "Returns the (cached, read-only) production matrix for the corresponding `quality_chance` and `production_ratio`."
+    return quality_matrix(quality_chance, model) * production_ratio
 
-def custom_production_matrix(parameters_per_row : List[Tuple[float, float]]) -> np.ndarray:
-    """Returns a production matrix where every row has a specific quality chance and prodution ratio.
+@matrix_cache()
+def custom_production_matrix(parameters_per_row : List[Tuple[float, float]], model : QualityModel = DEFAULT_QUALITY_MODEL, exact : bool = False) -> np.ndarray:
+    """Returns a (cached, read-only) production matrix where every row has a specific quality chance and prodution ratio.
 
     Args:
-        parameters_per_row (List[Tuple[float, float]]): List of five tuples. Each tuple indicates the
+        parameters_per_row (List[Tuple[float, float]]): List of five tuples (one per tier of the model). Each tuple indicates the
             quality chance (%) and production ratio for the respective row.
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
+        exact (bool, optional): If True, build the matrix out of `Fraction`s (see `exact_fraction`) instead of floats.
+            Much slower, but free of rounding errors. Defaults to False.
 
     Returns:
-        np.ndarray: 5x5 production matrix.
+        np.ndarray: 5x5 production matrix (tiers x tiers for other models). Its dtype is object in exact mode.
     """
 
     # Basic validations
-    assert len(parameters_per_row) == 5
+    assert len(parameters_per_row) == model.tiers
     assert type(parameters_per_row) == list
     for pair in parameters_per_row:
         assert type(pair) == tuple
         assert len(pair) == 2
 
-    res = np.zeros((5,5))
-    
-    for row in range(5):
-        quality_chance, production_ratio = parameters_per_row[row]
+    if exact:
+        res = np.empty((model.tiers, model.tiers), dtype=object)
 
-        for column in range(5):
-            res[row][column] = quality_probability(quality_chance, row, column) * production_ratio
-    
-    return res
+        for row, (quality_chance, production_ratio) in enumerate(parameters_per_row):
+            quality_chance, production_ratio = exact_fraction(quality_chance), exact_fraction(production_ratio)
+
+            for column in range(model.tiers):
+                res[row][column] = quality_probability(quality_chance, row, column, model) * production_ratio
+
+        return res
+
+    quality_chances, production_ratios = zip(*parameters_per_row)
+
+    return custom_production_matrices(np.array([quality_chances]), np.array([production_ratios]), model)[0]
+
+def custom_production_matrices(quality_chances : np.ndarray, production_ratios : np.ndarray, model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    """Batched version of `custom_production_matrix`.
+
+    Args:
+        quality_chances (np.ndarray): (N, tiers) array with the quality chance (%) of every row of every matrix.
+        production_ratios (np.ndarray): (N, tiers) array with the production ratio of every row of every matrix.
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
+
+    Returns:
+        np.ndarray: (N, tiers, tiers) stack of production matrices.
+    """
+    quality_chances   = np.asarray(quality_chances, dtype=float)
+    production_ratios = np.asarray(production_ratios, dtype=float)
+
+    # Basic validations
+    assert quality_chances.ndim == 2 and quality_chances.shape == production_ratios.shape
+
+    return quality_probabilities(quality_chances, production_ratios, model)
+
+def production_matrix_derivatives(parameters_per_row : List[Tuple[float, float]], model : QualityModel = DEFAULT_QUALITY_MODEL) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the derivatives of `custom_production_matrix(parameters_per_row)` with respect to the quality chance
+    and the production ratio of every row.
+
+    Args:
+        parameters_per_row (List[Tuple[float, float]]): Same as in `custom_production_matrix`.
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Two (tiers, tiers, tiers) arrays: the i-th matrix of the first one is the derivative
+            with respect to the quality chance (%) of row i, and the i-th matrix of the second one is the derivative with
+            respect to the production ratio of row i.
+    """
+    assert len(parameters_per_row) == model.tiers
+
+    d_quality_chances = np.zeros((model.tiers, model.tiers, model.tiers))
+    d_production_ratios = np.zeros((model.tiers, model.tiers, model.tiers))
+
+    # Row i is (identity_i + quality_chance_i/100 * coefficients_i) * production_ratio_i, and doesn't depend on the other rows
+    for i, (quality_chance, production_ratio) in enumerate(parameters_per_row):
+        d_quality_chances[i][i] = model.upgrade_coefficients[i] * production_ratio / 100
+        d_production_ratios[i][i] = np.eye(model.tiers)[i] + quality_chance / 100 * model.upgrade_coefficients[i]
+
+    return d_quality_chances, d_production_ratios
+
+def steady_state_derivatives(flows : np.ndarray, transition_matrix : np.ndarray, derivatives : np.ndarray) -> np.ndarray:
+    """Given the total flows of a loop, `flows = v @ inv(I - T)`, returns the derivatives of those flows
+    with respect to a set of parameters, using the closed form `d(flows) = flows @ dT @ inv(I - T)`.
+
+    Args:
+        flows (np.ndarray): Total flows of the loop.
+        transition_matrix (np.ndarray): Transition (or production) matrix T of the loop.
+        derivatives (np.ndarray): (P, n, n) stack with the derivative of T with respect to each of the P parameters.
+
+    Returns:
+        np.ndarray: (P, n) array: line p is the derivative of every flow with respect to parameter p.
+    """
+    n = len(transition_matrix)
+    d_step = np.einsum("j,pjk->pk", flows, derivatives)
+
+    return np.linalg.solve(np.eye(n) - transition_matrix.T, d_step.T).T
+
+def spectral_radius(transition_matrix : np.ndarray) -> float:
+    "Returns the spectral radius of `transition_matrix`. If it's 1 or above, the items in the loop grow forever."
+    return float(max(abs(np.linalg.eigvals(transition_matrix)), default=0))
+
+def check_convergence(radius : float):
+    """Checks that a loop whose transition matrix has a spectral radius of `radius` empties eventually.
+
+    Raises:
+        ValueError: If the radius is 1 or above (give or take rounding), i.e. the amount of items grows forever.
+    """
+    if radius >= 1 - 1E-9: # A radius of exactly 1 can come out of eigvals slightly below 1
+        raise ValueError(f"The loop does not converge (spectral radius of {radius}): the amount of items grows forever")
+
+def doubling_steady_state(input_vector : np.ndarray, transition_matrix : np.ndarray, tolerance : float = 1E-10) -> Tuple[np.ndarray, float, int]:
+    """Sums the flows of a loop, `v + vT + vT^2 + ...`, by repeated squaring: after k doublings the partial sum covers
+    2^k steps, so a loop that takes thousands of steps to empty only needs a few dozen matrix products.
+
+    With `P = T^(2^k)`, the rest of the series is `vSP (I + P + P^2 + ...)`, where `vS` is the partial sum. So the total flow
+    left out can't be larger than the total flow of `vSP` divided by `1 - ||P||` (max row sum of P), which is the error bound.
+
+    Args:
+        input_vector (np.ndarray): Flows going into the loop.
+        transition_matrix (np.ndarray): Transition (or production) matrix T of the loop.
+        tolerance (float, optional): Stop once the error bound (sum of every flow) is below this value. Defaults to 1E-10.
+
+    Raises:
+        ValueError: If the loop doesn't converge.
+
+    Returns:
+        Tuple[np.ndarray, float, int]: The total flows, their error bound and the number of doublings.
+    """
+    result = np.array(input_vector, dtype=float) # v + vT + ... + vT^(2^k - 1)
+    power = np.array(transition_matrix, dtype=float) # T^(2^k)
+
+    for doublings in range(1, 64):
+        result = result + result @ power
+        power = power @ power
+
+        norm = np.abs(power).sum(axis=1).max()
+        if norm < 1:
+            error_bound = float(np.abs(result @ power).sum() / (1 - norm))
+
+            if error_bound < tolerance:
+                return result, error_bound, doublings
+
+    raise ValueError("The loop does not converge: the amount of items grows forever")
+
+def exact_steady_state(input_vector : np.ndarray, transition_matrix : np.ndarray) -> np.ndarray:
+    """Exact counterpart of `np.linalg.solve(np.eye(n) - T.T, v)`: solves the total flows of a loop, `v @ inv(I - T)`,
+    by Gauss-Jordan elimination over `Fraction`s. There is no rounding at all, so the result is exactly the rational
+    number the loop converges to.
+
+    Args:
+        input_vector (np.ndarray): Flows going into the loop. Floats are converted with `exact_fraction`.
+        transition_matrix (np.ndarray): Transition (or production) matrix T of the loop, e.g. built in exact mode.
+
+    Raises:
+        ValueError: If `I - T` is singular, i.e. the loop never reaches a steady state.
+
+    Returns:
+        np.ndarray: The total flows, as an object array of `Fraction`s.
+    """
+    n = len(transition_matrix)
+
+    # Augmented matrix [I - T^T | v]
+    rows = [
+        [int(i == j) - exact_fraction(transition_matrix[j][i]) for j in range(n)] + [exact_fraction(input_vector[i])]
+        for i in range(n)
+    ]
+
+    for column in range(n):
+        pivot = next((row for row in range(column, n) if rows[row][column] != 0), None)
+        if pivot is None:
+            raise ValueError("The loop does not converge: the amount of items grows forever")
+
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        pivot_value = rows[column][column]
+        rows[column] = [value / pivot_value for value in rows[column]]
+
+        for row in range(n):
+            factor = rows[row][column]
+            if row != column and factor != 0:
+                rows[row] = [a - factor * b for a, b in zip(rows[row], rows[column])]
+
+    return np.array([row[n] for row in rows], dtype=object)
 
 if __name__ == "__main__":
     np.set_printoptions(suppress=True)
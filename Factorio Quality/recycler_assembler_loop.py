@@ -1,11 +1,27 @@
 import numpy as np
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, Dict, Iterator, MutableMapping
 import itertools
-from tqdm import tqdm
+from pathlib import Path
+from functools import partial
+from contextlib import nullcontext
 from enum import Enum
-import pandas
 
-from quality import custom_production_matrix
+# multiprocessing, shelve, tqdm and pandas are only needed by the exhaustive search and the efficiency table,
+# so they are imported where they are used: the solvers only need numpy, and importing pandas takes a few hundred ms.
+
+from quality import (
+    custom_production_matrix, custom_production_matrices, production_matrix_derivatives, steady_state_derivatives, doubling_steady_state,
+    exact_steady_state, exact_fraction, matrix_cache, spectral_radius, check_convergence, QualityModel, DEFAULT_QUALITY_MODEL
+)
+
+# Results of `recycler_assembler_efficiency` are cached on disk by `efficiency_table`.
+# Bump the version whenever the model (or the defaults it relies on) changes, so that stale results get thrown away.
+EFFICIENCY_CACHE_PATH = Path(__file__).parent / "efficiency_cache"
+EFFICIENCY_MODEL_VERSION = "3"
+
+# Default of `items_quality_to_keep` and `ingredients_quality_to_keep`: only the top tier of the model is removed
+# (legendary in the base game). It needs a value of its own, since None already means that nothing is removed.
+TOP_TIER = -1
 
 def custom_transition_matrix(recycler_matrix : np.ndarray, assembler_matrix : np.ndarray) -> np.ndarray:
     """Creates a transition matrix based on the 
@@ -19,40 +35,55 @@ def custom_transition_matrix(recycler_matrix : np.ndarray, assembler_matrix : np
         np.ndarray: Transition matrix with the recycler production matrix 
         in the lower left and assembler production matrix in the upper right.
     """
-    res = np.zeros((10,10))
+    tiers = len(recycler_matrix)
+    res = np.zeros((2 * tiers, 2 * tiers), dtype=recycler_matrix.dtype) # object in exact mode
 
-    for i in range(5):
-        for j in range(5):
-            res[i + 5][j] = recycler_matrix[i, j]
-            res[i][j + 5] = assembler_matrix[i, j]
+    res[tiers:, :tiers] = recycler_matrix
+    res[:tiers, tiers:] = assembler_matrix
 
     return res
 
+def first_removed_tier(quality_to_keep : Union[int, None], model : QualityModel = DEFAULT_QUALITY_MODEL) -> int:
+    "Returns the quality level from which items/ingredients are removed from the system, for an `*_quality_to_keep` argument."
+    if quality_to_keep == TOP_TIER:
+        return model.tiers
+    if quality_to_keep == None: # Nothing is removed
+        return model.tiers + 1
+    return quality_to_keep
+
 def get_recycler_parameters(
-        quality_to_keep : int = 5, # Don't recycle legendary items (default)
+        quality_to_keep : Union[int, None] = None, # Don't recycle legendary items (default)
         recipe_ratio : float = 1, # Ratio of items to ingredients of the recipe
-        qual_module_bonus : float = 6.2) -> List[Tuple[float, float]]:
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> List[Tuple[float, float]]:
     
+    if quality_to_keep is None:
+        quality_to_keep = model.tiers
+
     recycling_rows = quality_to_keep - 1
-    saving_rows = 5 - recycling_rows
+    saving_rows = model.tiers - recycling_rows
 
     # Recycler stats
-    production_ratio = 0.25 / recipe_ratio
+    production_ratio = 1 / (4 * recipe_ratio) # Stays a Fraction in exact mode
     quality_chance = 4 * qual_module_bonus
 
     return [(quality_chance, production_ratio)] * recycling_rows + [(0, 0)] * saving_rows
 
 def get_assembler_parameters(
         assembler_modules_config : Union[Tuple[float, float], List[Tuple[float, float]]], # Modules configuration of assemblers for every quality level
-        quality_to_keep : int = 5, # Don't assemble legendary ingredients (default)
+        quality_to_keep : Union[int, None] = None, # Don't assemble legendary ingredients (default)
         base_prod_bonus : float = 0, # base productivity of assembler + productivity technologies
         recipe_ratio : float = 1, # Ratio of items to ingredients of the recipe
         prod_module_bonus : float = 25,
-        qual_module_bonus : float = 6.2) -> List[Tuple[float, float]]:
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> List[Tuple[float, float]]:
     
+    if quality_to_keep is None:
+        quality_to_keep = model.tiers
+
     production_rows = quality_to_keep - 1
 
-    res = [(0, 0)] * 5
+    res = [(0, 0)] * model.tiers
 
     for i, (prod_count, qual_count) in enumerate(assembler_modules_config):
         if i == production_rows:
@@ -66,70 +97,251 @@ def get_assembler_parameters(
 
     return res
 
+@matrix_cache()
+def recycler_assembler_transition_matrix(
+        assembler_modules_config : Tuple[Tuple[float, float], ...], # Modules configuration of assemblers for every quality level
+        items_quality_to_keep : Union[int, None] = TOP_TIER, # Don't recycle legendary items (default)
+        ingredients_quality_to_keep : Union[int, None] = TOP_TIER, # Don't assemble legendary ingredients (default)
+        base_prod_bonus : float = 0, # base productivity of assembler + productivity technologies
+        recipe_ratio : float = 1, # Ratio of items to ingredients of the recipe
+        prod_module_bonus : float = 25,
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL,
+        exact : bool = False) -> np.ndarray:
+    """Builds the transition matrix of a recycler/assembler loop. The arguments mean the same as in `recycler_assembler_loop`,
+    except that `assembler_modules_config` must be a tuple with one (productivity, quality) pair per quality level so that it can be cached.
+
+    The result is cached and read-only: the same matrix is shared by every caller asking for the same setup.
+
+    Returns:
+        np.ndarray: Read-only 10x10 transition matrix (2*tiers x 2*tiers for other models), made of `Fraction`s if `exact` is True.
+    """
+    if exact:
+        base_prod_bonus, recipe_ratio, prod_module_bonus, qual_module_bonus = map(
+            exact_fraction, (base_prod_bonus, recipe_ratio, prod_module_bonus, qual_module_bonus)
+        )
+
+    recycler_parameters  = get_recycler_parameters(
+        first_removed_tier(items_quality_to_keep, model),
+        recipe_ratio,
+        qual_module_bonus,
+        model
+    )
+    assembler_parameters = get_assembler_parameters(
+        assembler_modules_config,
+        first_removed_tier(ingredients_quality_to_keep, model),
+        base_prod_bonus,
+        recipe_ratio,
+        prod_module_bonus,
+        qual_module_bonus,
+        model
+    )
+
+    res = custom_transition_matrix(
+        custom_production_matrix(recycler_parameters, model, exact),
+        custom_production_matrix(assembler_parameters, model, exact)
+    )
+
+    return res
+
+def solve_transition_matrix(
+        input_vector : np.ndarray,
+        transition_matrix : np.ndarray,
+        iterative : bool = False,
+        accelerated : bool = False,
+        exact : bool = False,
+        return_error_bound : bool = False) -> Union[np.ndarray, Tuple[np.ndarray, float, int]]:
+    """Returns the total flows of `input_vector` going through the system described by `transition_matrix`
+    until there's nothing left in it.
+
+    Args:
+        input_vector (np.ndarray): The ingredients and items intake of the system.
+        transition_matrix (np.ndarray): 10x10 transition matrix, e.g. from `recycler_assembler_transition_matrix`.
+        iterative (bool, optional): If True, simulate the loop step by step instead of solving it directly.
+            Useful to cross-check the closed-form solution. Defaults to False.
+        accelerated (bool, optional): If True (and `iterative` is True), sum the steps by repeated squaring
+            (see `doubling_steady_state`) instead of one step at a time. Defaults to False.
+        exact (bool, optional): If True, solve the system with rational arithmetic (see `exact_steady_state`).
+            Can't be combined with `iterative`. Defaults to False.
+        return_error_bound (bool, optional): If True (only with `iterative` and `accelerated`), also return the error bound
+            of the flows and the number of doublings it took, as `doubling_steady_state` does. Defaults to False.
+
+    Raises:
+        ValueError: If the system never empties (spectral radius >= 1), i.e. the amount of items grows forever.
+
+    Returns:
+        np.ndarray: Sum of the flows of every step, see `recycler_assembler_loop`.
+            With `return_error_bound`, a tuple with those flows, their error bound and the number of doublings.
+    """
+    assert not return_error_bound or (iterative and accelerated)
+
+    check_convergence(spectral_radius(transition_matrix.astype(float)))
+
+    if exact:
+        assert not iterative
+        return exact_steady_state(input_vector, transition_matrix)
+
+    if not iterative:
+        # The total flow is v + vT + vT^2 + ... = v @ inv(I - T)
+        return np.linalg.solve(np.eye(len(transition_matrix)) - transition_matrix.T, input_vector)
+
+    if accelerated:
+        flows, error_bound, doublings = doubling_steady_state(input_vector, transition_matrix)
+        return (flows, error_bound, doublings) if return_error_bound else flows
+
+    return sum(transition_matrix_steps(input_vector, transition_matrix))
+
+def transition_matrix_steps(input_vector : np.ndarray, transition_matrix : np.ndarray) -> Iterator[np.ndarray]:
+    """Yields the flows of the system described by `transition_matrix` at every step, starting with `input_vector`,
+    until there's nothing left in it. The sum of every step is the result of `solve_transition_matrix`.
+    Only the current step is kept in memory. Never ends if the system doesn't converge.
+    """
+    flow = input_vector
+    yield flow
+
+    while True:
+        next_flow = flow @ transition_matrix
+        yield next_flow
+
+        if sum(abs(flow - next_flow)) < 1E-10:
+            # There's nothing left in the system
+            break
+
+        flow = next_flow
+
 def recycler_assembler_loop(
         input_vector : Union[np.array, float],
         assembler_modules_config : Union[Tuple[float, float], List[Tuple[float, float]]], # Modules configuration of assemblers for every quality level
-        items_quality_to_keep : Union[int, None] = 5, # Don't recycle legendary items (default)
-        ingredients_quality_to_keep : Union[int, None] = 5, # Don't assemble legendary ingredients (default)
+        items_quality_to_keep : Union[int, None] = TOP_TIER, # Don't recycle legendary items (default)
+        ingredients_quality_to_keep : Union[int, None] = TOP_TIER, # Don't assemble legendary ingredients (default)
         base_prod_bonus : float = 0, # base productivity of assembler + productivity technologies
         recipe_ratio : float = 1, # Ratio of items to ingredients of the recipe
         prod_module_bonus : float = 25,
-        qual_module_bonus : float = 6.2) -> np.array:
+        qual_module_bonus : float = 6.2,
+        iterative : bool = False,
+        accelerated : bool = False,
+        model : QualityModel = DEFAULT_QUALITY_MODEL,
+        exact : bool = False,
+        return_error_bound : bool = False) -> Union[np.array, Tuple[np.array, float, int]]:
     """Returns a vector with values for each quality level that mean different things, depending on whether that quality is kept or recycled:
         - If the quality is kept: the value is the production rate of ingredients/items of that quality level.
         - If the quality is recycled: the value is the internal flow rate of ingredients/items of that quality level in the system.
     
-    The first five values represent the ingredients and the last five values represent the items.
+    The first five values represent the ingredients and the last five values represent the items
+    (with other quality models, the first `tiers` values are the ingredients and the last `tiers` values are the items).
 
     Args:
         input_vector (Union[np.array, float]): The ingredients and items intake of the system.
         assembler_modules_config (Union[Tuple[float, float], List[Tuple[float, float]]]): Number of productivity and quality modules for the assemblers of each quality of item.
-        items_quality_to_keep (Union[int, None], optional): Minimum quality level of the items to be removed from the system. Defaults to 5 (Legendary). If set to None, nothing is removed.
-        ingredients_quality_to_keep (Union[int, None], optional): Minimum quality level of the ingredients to be removed from the system. Defaults to 5 (Legendary). If set to None, nothing is removed.
+        items_quality_to_keep (Union[int, None], optional): Minimum quality level of the items to be removed from the system. Defaults to `TOP_TIER` (Legendary). If set to None, nothing is removed.
+        ingredients_quality_to_keep (Union[int, None], optional): Minimum quality level of the ingredients to be removed from the system. Defaults to `TOP_TIER` (Legendary). If set to None, nothing is removed.
         base_prod_bonus (float, optional): Base productivity of assembler + productivity technologies. Defaults to 0.
         recipe_ratio (float, optional): Ratio of items to ingredients of the crafting recipe. Defaults to 1.
         prod_module_bonus (float, optional): Productivity bonus from productivity modules. Defaults to 25%.
         qual_module_bonus (float, optional): Quality chance bonus from quality modules. Defaults to 6.2%.
+        iterative (bool, optional): If True, simulate the loop step by step instead of solving it directly. Defaults to False.
+        accelerated (bool, optional): If True (and `iterative` is True), simulate the loop by repeated squaring. Defaults to False.
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
+        exact (bool, optional): If True, solve the loop with rational arithmetic: the result is made of `Fraction`s, with no rounding
+            error at all. Floats in the arguments are read as the decimals they are written as. Much slower. Defaults to False.
+        return_error_bound (bool, optional): If True (only with `iterative` and `accelerated`), also return the error bound of the
+            flows and the number of doublings it took. Defaults to False.
+
+    Raises:
+        ValueError: If the setup never reaches a steady state (e.g. the productivity is so high that the items grow forever).
 
     Returns:
         np.array: Vector with values for each quality level. The first five values represent the ingredients and the last five values represent the items.
+            With `return_error_bound`, a tuple with that vector, its error bound and the number of doublings.
     """
     
     if type(assembler_modules_config) == tuple:
-        assembler_modules_config = [assembler_modules_config] * 5
+        assembler_modules_config = [assembler_modules_config] * model.tiers
+
+    transition_matrix = recycler_assembler_transition_matrix(
+        tuple(tuple(modules) for modules in assembler_modules_config),
+        items_quality_to_keep,
+        ingredients_quality_to_keep,
+        base_prod_bonus,
+        recipe_ratio,
+        prod_module_bonus,
+        qual_module_bonus,
+        model,
+        exact
+    )
+
+    if type(input_vector) in (float, int):
+        input_vector = np.array([input_vector] + [0] * (2 * model.tiers - 1))
+
+    return solve_transition_matrix(input_vector, transition_matrix, iterative, accelerated, exact, return_error_bound)
+
+def recycler_assembler_sensitivity(
+        input_vector : Union[np.array, float],
+        assembler_modules_config : Union[Tuple[float, float], List[Tuple[float, float]]],
+        items_quality_to_keep : Union[int, None] = TOP_TIER,
+        ingredients_quality_to_keep : Union[int, None] = TOP_TIER,
+        base_prod_bonus : float = 0,
+        recipe_ratio : float = 1,
+        prod_module_bonus : float = 25,
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Same as `recycler_assembler_loop`, but also returns the derivatives of the result with respect to the quality chance
+    and production ratio of the assemblers and recyclers of every quality level. The arguments mean the same as in `recycler_assembler_loop`.
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, np.ndarray]]: The result of `recycler_assembler_loop`, and a dictionary with the keys
+            "assembler_quality_chances", "assembler_production_ratios", "recycler_quality_chances" and "recycler_production_ratios".
+            Each value is a (tiers, 2 * tiers) array where the element [i, k] is the derivative of the result's value k
+            with respect to that parameter of the machines of quality level i + 1. E.g. `[:, 9]` is the gradient of the legendary items output.
+    """
+    if type(assembler_modules_config) == tuple:
+        assembler_modules_config = [assembler_modules_config] * model.tiers
+
+    flows = recycler_assembler_loop(
+        input_vector, assembler_modules_config, items_quality_to_keep, ingredients_quality_to_keep,
+        base_prod_bonus, recipe_ratio, prod_module_bonus, qual_module_bonus, model=model
+    )
+    transition_matrix = recycler_assembler_transition_matrix(
+        tuple(tuple(modules) for modules in assembler_modules_config),
+        items_quality_to_keep,
+        ingredients_quality_to_keep,
+        base_prod_bonus,
+        recipe_ratio,
+        prod_module_bonus,
+        qual_module_bonus,
+        model
+    )
 
-    # Parameters for the production matrices
     recycler_parameters  = get_recycler_parameters(
-        items_quality_to_keep if items_quality_to_keep != None else 6,
+        first_removed_tier(items_quality_to_keep, model),
         recipe_ratio,
-        qual_module_bonus
+        qual_module_bonus,
+        model
     )
     assembler_parameters = get_assembler_parameters(
         assembler_modules_config,
-        ingredients_quality_to_keep if ingredients_quality_to_keep != None else 6,
+        first_removed_tier(ingredients_quality_to_keep, model),
         base_prod_bonus,
         recipe_ratio,
         prod_module_bonus,
-        qual_module_bonus
+        qual_module_bonus,
+        model
     )
 
-    if type(input_vector) in (float, int):
-        input_vector = np.array([input_vector] + [0] * 9)
-    
-    result_flows = [input_vector]
-    while True:
-        result_flows.append(
-            result_flows[-1] @ custom_transition_matrix(
-                custom_production_matrix(recycler_parameters), 
-                custom_production_matrix(assembler_parameters)
-            )
-        )
+    zeros = np.zeros((model.tiers, model.tiers))
+    res = {}
 
-        if sum(abs(result_flows[-2] - result_flows[-1])) < 1E-10:
-            # There's nothing left in the system
-            break
+    # Place the derivatives of the production matrices in their block of the transition matrix
+    for machine, parameters in (("assembler", assembler_parameters), ("recycler", recycler_parameters)):
+        for parameter, derivatives in zip(("quality_chances", "production_ratios"), production_matrix_derivatives(parameters, model)):
+            if machine == "assembler":
+                derivatives = np.array([custom_transition_matrix(zeros, d) for d in derivatives])
+            else:
+                derivatives = np.array([custom_transition_matrix(d, zeros) for d in derivatives])
+
+            res[f"{machine}_{parameter}"] = steady_state_derivatives(flows, transition_matrix, derivatives)
 
-    return sum(result_flows)
+    return flows, res
 
 def factorio_wiki_repro():
     print(custom_production_matrix([(25, 0.25)] * 4 + [(0, 0)]))
@@ -161,22 +373,8 @@ def get_config_string(config : List[Tuple[int, int]]):
 def correlation_optimal_modules_max_items():
     print("(F) Optimal modules, max items")
 
-    best_config = None
-    best_efficiency = 0
+    best_config, best_efficiency = optimal_modules_config(4, 0, SystemOutput.ITEMS)
 
-    all_configs = get_all_configs(4)
-
-    for config in tqdm(list(all_configs)):
-        if config[4] != (4, 0):
-            # Makes no sense to put quality modules on legendary item crafter
-            continue
-
-        efficiency = float(recycler_assembler_loop(100, config, ingredients_quality_to_keep = None)[9])
-
-        if best_efficiency < efficiency:
-            best_config = config
-            best_efficiency = efficiency
-    
     print(f"Optimal config: {get_config_string(best_config)}")
     print(f"Optimal efficiency: {best_efficiency}%")
     # https://docs.google.com/spreadsheets/d/1fGQry4MZ6S95vWrt59TQoNRy1yJMx-er202ai0r4R-w/edit?gid=0#gid=0&range=G14
@@ -198,22 +396,8 @@ def correlation_prod_only_max_ingredients():
 def correlation_optimal_modules_max_ingredients():
     print("(I) Optimal modules, max ingredients")
 
-    best_config = None
-    best_efficiency = 0
-
-    all_configs = get_all_configs(4)
-
-    for config in tqdm(list(all_configs)):
-        if config[4] != (4, 0):
-            # Makes no sense to put quality modules on legendary item crafter
-            continue
+    best_config, best_efficiency = optimal_modules_config(4, 0, SystemOutput.INGREDIENTS)
 
-        efficiency = float(recycler_assembler_loop(100, list(config), items_quality_to_keep = None)[4])
-
-        if best_efficiency < efficiency:
-            best_config = config
-            best_efficiency = efficiency
-    
     print(f"Optimal config: {get_config_string(best_config)}")
     print(f"Optimal efficiency: {best_efficiency}%")
     # https://docs.google.com/spreadsheets/d/1fGQry4MZ6S95vWrt59TQoNRy1yJMx-er202ai0r4R-w/edit?gid=0#gid=0&range=J14
@@ -240,7 +424,7 @@ class ModuleStrategy(Enum):
     FULL_PRODUCTIVITY = 1
     OPTIMIZE = 2
 
-def get_all_configs(module_slots : int):
+def get_all_configs(module_slots : int, model : QualityModel = DEFAULT_QUALITY_MODEL):
     "Generate all possible configurations for an assembler with `n` module slots."
     module_variations_for_assembler = []
 
@@ -248,30 +432,264 @@ def get_all_configs(module_slots : int):
         q = module_slots - p
         module_variations_for_assembler.append((p, q))
     
-    res = list(itertools.product(* [module_variations_for_assembler] * 5))
+    res = list(itertools.product(* [module_variations_for_assembler] * model.tiers))
 
     for i in range(len(res)):
         res[i] = list(res[i])
     
     return res
 
+def get_valid_configs(module_slots : int, model : QualityModel = DEFAULT_QUALITY_MODEL):
+    """Generate all the configurations worth considering for an assembler with `n` module slots:
+    it makes no sense to put quality modules on the legendary item crafter, so it always gets full productivity."""
+    module_variations_for_assembler = [(p, module_slots - p) for p in range(module_slots + 1)]
+
+    return [
+        list(config) + [(module_slots, 0)]
+        for config in itertools.product(* [module_variations_for_assembler] * (model.tiers - 1))
+    ]
+
+def get_system_output_parameters(system_output : SystemOutput, model : QualityModel = DEFAULT_QUALITY_MODEL) -> Tuple[Union[int, None], Union[int, None], int]:
+    "Returns the items quality to keep, ingredients quality to keep and index of the legendary output for `system_output`."
+    if system_output == SystemOutput.ITEMS:
+        return model.tiers, None, 2 * model.tiers - 1
+    else: # system_output == SystemOutput.INGREDIENTS:
+        return None, model.tiers, model.tiers - 1
+
+def config_efficiency(
+        config : List[Tuple[int, int]],
+        base_productivity : float,
+        system_output : SystemOutput,
+        input_tier : int = 0,
+        recipe_ratio : float = 1,
+        prod_module_bonus : float = 25,
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> float:
+    "Returns the efficiency (%) of the setup with modules configuration `config`, when fed ingredients of quality `input_tier`."
+    keep_items, keep_ingredients, result_index = get_system_output_parameters(system_output, model)
+
+    input_vector = np.zeros(2 * model.tiers)
+    input_vector[input_tier] = 100
+
+    output = recycler_assembler_loop(
+        input_vector, config, keep_items, keep_ingredients, base_productivity,
+        recipe_ratio, prod_module_bonus, qual_module_bonus, model=model
+    )
+    return float(output[result_index])
+
+def optimal_modules_config(
+        module_slots : int,
+        base_productivity : float,
+        system_output : SystemOutput,
+        exhaustive : bool = False,
+        processes : Union[int, None] = None,
+        recipe_ratio : float = 1,
+        prod_module_bonus : float = 25,
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> Tuple[List[Tuple[int, int]], float]:
+    """Returns the modules configuration that maximizes the efficiency of the setup, along with that efficiency (%).
+
+    Items and ingredients can only go up in quality, so the modules of the assemblers of a quality level only affect
+    the flows of that quality level and above. This means that the best configuration can be found tier by tier,
+    from legendary down to normal: the best modules for a tier are the ones that maximize the output per ingredient
+    of that tier, given the (already optimal) modules of the tiers above it. That's (slots + 1) * 4 evaluations
+    instead of (slots + 1) ^ 4.
+
+    Args:
+        module_slots (int): Number of module slots of the assemblers.
+        base_productivity (float): Base productivity of the assemblers + productivity technologies.
+        system_output (SystemOutput): Whether the system outputs legendary items or legendary ingredients.
+        exhaustive (bool, optional): Evaluate every valid configuration instead, to cross-check the tier by tier search.
+            Defaults to False.
+        processes (Union[int, None], optional): Size of the process pool used by the exhaustive search.
+            Defaults to None (one process per CPU).
+        recipe_ratio (float, optional): Ratio of items to ingredients of the crafting recipe. Defaults to 1.
+        prod_module_bonus (float, optional): Productivity bonus from productivity modules. Defaults to 25%.
+        qual_module_bonus (float, optional): Quality chance bonus from quality modules. Defaults to 6.2%.
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
+
+    Returns:
+        Tuple[List[Tuple[int, int]], float]: Best configuration and its efficiency.
+    """
+    bonuses = dict(recipe_ratio=recipe_ratio, prod_module_bonus=prod_module_bonus, qual_module_bonus=qual_module_bonus)
+
+    if exhaustive:
+        import multiprocessing
+        from tqdm import tqdm
+
+        configs = get_valid_configs(module_slots, model)
+
+        with multiprocessing.Pool(processes) as pool:
+            efficiencies = list(tqdm(
+                pool.imap(
+                    partial(config_efficiency, base_productivity=base_productivity, system_output=system_output, **bonuses, model=model),
+                    configs,
+                    chunksize=64
+                ),
+                total=len(configs)
+            ))
+        
+        best = int(np.argmax(efficiencies))
+        return configs[best], efficiencies[best]
+
+    module_variations_for_assembler = [(p, module_slots - p) for p in range(module_slots + 1)]
+
+    # Makes no sense to put quality modules on legendary item crafter
+    best_config = [(module_slots, 0)]
+
+    for tier in reversed(range(model.tiers - 1)):
+        best_modules = None
+        best_efficiency = -1
+
+        for modules in module_variations_for_assembler:
+            # The lower tiers never see the ingredients fed in at this tier, so their modules don't matter
+            efficiency = config_efficiency(
+                [modules] * (tier + 1) + best_config, base_productivity, system_output, tier, **bonuses, model=model
+            )
+
+            if best_efficiency < efficiency:
+                best_modules = modules
+                best_efficiency = efficiency
+        
+        best_config = [best_modules] + best_config
+
+    return best_config, config_efficiency(best_config, base_productivity, system_output, **bonuses, model=model)
+
+def recycler_assembler_loop_batch(
+        input_vector : Union[np.ndarray, float],
+        assembler_modules_configs : List[List[Tuple[int, int]]],
+        items_quality_to_keep : Union[int, None] = TOP_TIER,
+        ingredients_quality_to_keep : Union[int, None] = TOP_TIER,
+        base_prod_bonus : float = 0,
+        recipe_ratio : float = 1,
+        prod_module_bonus : float = 25,
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> np.ndarray:
+    """Batched version of `recycler_assembler_loop`: solves the loop for many modules configurations at once, with a single
+    stacked linear solve. The arguments mean the same as in `recycler_assembler_loop`, except that `assembler_modules_configs`
+    is a list of configurations, each one with a (productivity, quality) pair per quality level.
+
+    Raises:
+        ValueError: If any of the setups never reaches a steady state.
+
+    Returns:
+        np.ndarray: (N, 2 * tiers) array. Line i is what `recycler_assembler_loop` returns for the i-th configuration.
+    """
+    tiers = model.tiers
+    configs = np.array(assembler_modules_configs, dtype=float)
+    assert configs.ndim == 3 and configs.shape[1:] == (tiers, 2) # One (productivity, quality) pair per quality level
+    production_rows = first_removed_tier(ingredients_quality_to_keep, model) - 1
+
+    # Same as `get_assembler_parameters`, for every configuration at once
+    production_ratios = (100 + np.minimum(base_prod_bonus + configs[:, :, 0] * prod_module_bonus, 300)) * recipe_ratio / 100
+    quality_chances = configs[:, :, 1] * qual_module_bonus
+    production_ratios[:, production_rows:] = 0
+    quality_chances[:, production_rows:] = 0
+
+    recycler_parameters = get_recycler_parameters(
+        first_removed_tier(items_quality_to_keep, model), recipe_ratio, qual_module_bonus, model
+    )
+
+    transition_matrices = np.zeros((len(configs), 2 * tiers, 2 * tiers))
+    transition_matrices[:, tiers:, :tiers] = custom_production_matrix(recycler_parameters, model)
+    transition_matrices[:, :tiers, tiers:] = custom_production_matrices(quality_chances, production_ratios, model)
+
+    check_convergence(np.abs(np.linalg.eigvals(transition_matrices)).max(initial=0))
+
+    if type(input_vector) in (float, int):
+        input_vector = np.array([input_vector] + [0] * (2 * tiers - 1))
+
+    # The total flow is v + vT + vT^2 + ... = v @ inv(I - T), for every T
+    systems = np.eye(2 * tiers) - transition_matrices.transpose(0, 2, 1)
+    return np.linalg.solve(systems, np.broadcast_to(np.asarray(input_vector, dtype=float), (len(configs), 2 * tiers))[..., None])[..., 0]
+
+def pareto_front(objectives : np.ndarray) -> np.ndarray:
+    """Returns the indices of the non-dominated rows of `objectives`, where every column is an objective to minimize.
+    A row is dominated if another row is at least as good in every objective and strictly better in one of them.
+
+    The rows are sorted lexicographically first: a row can then only be dominated by rows that come before it,
+    so each row only needs to be compared with the front found so far, which is usually much smaller than the whole set.
+
+    Args:
+        objectives (np.ndarray): (N, k) array with the k objectives of the N candidates.
+
+    Returns:
+        np.ndarray: Indices of the candidates on the Pareto front, in lexicographic order of their objectives.
+    """
+    order = np.lexsort(objectives.T[::-1])
+    front = []
+
+    for i in order:
+        candidate = objectives[i]
+
+        if front:
+            others = objectives[front]
+            if np.any(np.all(others <= candidate, axis=1) & np.any(others < candidate, axis=1)):
+                continue
+
+        front.append(i)
+
+    return np.array(front, dtype=int)
+
+def pareto_modules_configs(
+        module_slots : int,
+        base_productivity : float,
+        system_output : SystemOutput,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> List[Tuple[List[Tuple[int, int]], float, float, int]]:
+    """Unlike `optimal_modules_config`, which only maximizes the efficiency, returns every modules configuration that is
+    worth considering when trading off:
+        - The efficiency (%), to maximize.
+        - The total internal flow of ingredients and items per 100 ingredients, to minimize. It's proportional
+          to the number of assemblers and recyclers that the setup needs.
+        - The number of quality modules per set of assemblers (one assembler per quality level), to minimize.
+
+    Every valid configuration is evaluated at once with `recycler_assembler_loop_batch`, and the ones that are not
+    dominated by any other (the Pareto front) are returned.
+
+    Args:
+        module_slots (int): Number of module slots of the assemblers.
+        base_productivity (float): Base productivity of the assemblers + productivity technologies.
+        system_output (SystemOutput): Whether the system outputs legendary items or legendary ingredients.
+        model (QualityModel, optional): Quality model. Defaults to the base game's.
+
+    Returns:
+        List[Tuple[List[Tuple[int, int]], float, float, int]]: Configuration, efficiency, internal flow and number
+            of quality modules of every configuration on the front, from the most to the least efficient.
+    """
+    keep_items, keep_ingredients, result_index = get_system_output_parameters(system_output, model)
+    configs = get_valid_configs(module_slots, model)
+
+    flows = recycler_assembler_loop_batch(100, configs, keep_items, keep_ingredients, base_productivity, model=model)
+
+    # Flows of the qualities that are kept are outputs, not internal flows
+    internal = np.ones(2 * model.tiers, dtype=bool)
+    internal[:model.tiers][first_removed_tier(keep_ingredients, model) - 1:] = False
+    internal[model.tiers:][first_removed_tier(keep_items, model) - 1:] = False
+
+    efficiencies = flows[:, result_index]
+    internal_flows = flows[:, internal].sum(axis=1)
+    quality_modules = np.array([sum(q for _, q in config) for config in configs])
+
+    front = pareto_front(np.column_stack((-efficiencies, internal_flows, quality_modules)))
+
+    return [
+        (configs[i], float(efficiencies[i]), float(internal_flows[i]), int(quality_modules[i]))
+        for i in front
+    ]
+
 def recycler_assembler_efficiency(
         module_slots : int,
         base_productivity : float,
         system_output : SystemOutput,
-        module_strategy : ModuleStrategy) -> float:
+        module_strategy : ModuleStrategy,
+        recipe_ratio : float = 1,
+        prod_module_bonus : float = 25,
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> float:
     "Returns the efficiency of the setup with the given parameters (%)."
     assert module_slots >= 0 and base_productivity >= 0
 
-    if system_output == SystemOutput.ITEMS:
-        keep_items = 5
-        keep_ingredients = None
-    else: # system_output == SystemOutput.INGREDIENTS:
-        keep_items = None
-        keep_ingredients = 5
-    
-    # What is the output of the system: ingredients or items?
-    result_index = 4 if system_output == SystemOutput.INGREDIENTS else 9
+    keep_items, keep_ingredients, result_index = get_system_output_parameters(system_output, model)
     
     if module_strategy != ModuleStrategy.OPTIMIZE:
         if module_strategy == ModuleStrategy.FULL_PRODUCTIVITY:
@@ -279,29 +697,66 @@ def recycler_assembler_efficiency(
         else:
             config = (0, module_slots)
         
-        output = recycler_assembler_loop(100, config, keep_items, keep_ingredients, base_productivity)
+        output = recycler_assembler_loop(
+            100, config, keep_items, keep_ingredients, base_productivity,
+            recipe_ratio, prod_module_bonus, qual_module_bonus, model=model
+        )
         return output[result_index]
     else:
-        best_config = None
-        best_efficiency = 0
+        _, best_efficiency = optimal_modules_config(
+            module_slots, base_productivity, system_output,
+            recipe_ratio=recipe_ratio, prod_module_bonus=prod_module_bonus, qual_module_bonus=qual_module_bonus, model=model
+        )
+        return best_efficiency
 
-        all_configs = get_all_configs(module_slots)
+def efficiency_cache_key(
+        module_slots : int,
+        base_productivity : float,
+        system_output : SystemOutput,
+        module_strategy : ModuleStrategy,
+        recipe_ratio : float = 1,
+        prod_module_bonus : float = 25,
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> str:
+    "Returns the key of the result of `recycler_assembler_efficiency` in the efficiency cache, made of every numeric input of the setup."
+    keep_items, keep_ingredients, _ = get_system_output_parameters(system_output, model)
+
+    return repr((
+        model.tiers,
+        model.decay,
+        module_slots,
+        float(base_productivity),
+        keep_items,
+        keep_ingredients,
+        module_strategy.name,
+        float(recipe_ratio),
+        float(prod_module_bonus),
+        float(qual_module_bonus),
+    ))
 
-        for config in tqdm(list(all_configs)):
-            if config[4] != (module_slots, 0):
-                # Makes no sense to put quality modules on legendary item crafter
-                continue
-            
-            output = recycler_assembler_loop(100, list(config), keep_items, keep_ingredients, base_productivity)
-            efficiency = float(output[result_index])
+def cached_recycler_assembler_efficiency(
+        cache : MutableMapping[str, float], # e.g. a shelve.Shelf
+        module_slots : int,
+        base_productivity : float,
+        system_output : SystemOutput,
+        module_strategy : ModuleStrategy,
+        recipe_ratio : float = 1,
+        prod_module_bonus : float = 25,
+        qual_module_bonus : float = 6.2,
+        model : QualityModel = DEFAULT_QUALITY_MODEL) -> float:
+    "Same as `recycler_assembler_efficiency`, but only computes the efficiency if it isn't in `cache` already."
+    setup = (module_slots, base_productivity, system_output, module_strategy, recipe_ratio, prod_module_bonus, qual_module_bonus)
+    key = efficiency_cache_key(*setup, model=model)
 
-            if best_efficiency < efficiency:
-                best_config = config
-                best_efficiency = efficiency
-        
-        return best_efficiency
+    if key not in cache:
+        cache[key] = float(recycler_assembler_efficiency(*setup, model=model))
+
+    return cache[key]
+
+def efficiency_table(use_cache : bool = True):
+    import shelve
+    import pandas
 
-def efficiency_table():
     DATA = { # (number of slots, base productivity)
         "Electric furnace/Centrifuge" : (2, 0),
         "Chemical Plant"              : (3, 0),
@@ -327,11 +782,17 @@ def efficiency_table():
 
     table = {key : {} for key in DATA}
 
-    for assembler_type, (slots, base_prod) in DATA.items():
-        for output in OUTPUTS:
-            for strategy in STRATEGIES:
-                eff = recycler_assembler_efficiency(slots, base_prod, output, strategy)
-                table[assembler_type][KEY_NAMES[(output, strategy)]] = eff
+    # Without the cache, we use a throwaway dict in its place
+    with shelve.open(str(EFFICIENCY_CACHE_PATH)) if use_cache else nullcontext({}) as cache:
+        if cache.get("__version__") != EFFICIENCY_MODEL_VERSION:
+            cache.clear()
+            cache["__version__"] = EFFICIENCY_MODEL_VERSION
+
+        for assembler_type, (slots, base_prod) in DATA.items():
+            for output in OUTPUTS:
+                for strategy in STRATEGIES:
+                    eff = cached_recycler_assembler_efficiency(cache, slots, base_prod, output, strategy)
+                    table[assembler_type][KEY_NAMES[(output, strategy)]] = eff
     
     print(pandas.DataFrame(table).T.to_string())
 
@@ -343,16 +804,10 @@ def simple_recycler_assembler_loop():
         custom_production_matrix([(25, 1.5)] * 5)
     )
     
-    result_flows = [input_vector]
-    while True:
-        result_flows.append(result_flows[-1] @ transition_matrix)
-
-        if sum(abs(result_flows[-2] - result_flows[-1])) < 1E-10:
-            # There's nothing left in the system
-            break
+    result = solve_transition_matrix(input_vector, transition_matrix)
 
-    print(sum(result_flows))
-    print(" & ".join([str(float(round(i, 5))) for i in sum(result_flows)]))
+    print(result)
+    print(" & ".join([str(float(round(i, 5))) for i in result]))
 
 if __name__ == "__main__":
     np.set_printoptions(suppress=True, linewidth = 1000)
@@ -0,0 +1,128 @@
+"""Solves batches of quality loop queries in a single process, so that the imports and the matrix caches are shared between them.
+
+Queries are JSON objects, one per line. Each one names the loop to solve and the keyword arguments of the matching function:
+
+    {"id": 1, "loop": "recycler", "input": 100, "quality_chance": 24.8}
+    {"id": 2, "loop": "asteroid_crusher", "input": 100, "quality_chance": 24.8, "quality_to_keep": 4}
+    {"id": 3, "loop": "recycler_assembler", "input": 100, "assembler_modules_config": [2, 2], "ingredients_quality_to_keep": null}
+
+A quality model other than the base game's can be picked with `"model": {"tiers": 7, "decay": 5}`.
+Every query gets one JSON line back, in the same order: `{"id": ..., "result": [...]}` or `{"id": ..., "error": "..."}`.
+
+    python service.py queries.jsonl          # or pipe the queries into stdin
+    python service.py --server --port 8765   # keeps the caches warm between connections
+"""
+import argparse
+import json
+import socketserver
+import sys
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Set, Tuple, Union
+
+import numpy as np
+
+from quality import QualityModel, DEFAULT_QUALITY_MODEL
+from pure_recycler_loop import recycler_loop
+from asteroid_crusher_loop import asteroid_crusher_loop
+from recycler_assembler_loop import recycler_assembler_loop
+
+# Solver of each kind of loop, and the keyword arguments a query may pass to it
+LOOPS : Dict[str, Tuple[Callable[..., np.ndarray], Set[str]]] = {
+    "recycler" : (recycler_loop, {
+        "quality_chance", "quality_to_keep", "production_ratio", "iterative", "accelerated"
+    }),
+    "asteroid_crusher" : (asteroid_crusher_loop, {
+        "quality_chance", "quality_to_keep", "iterative"
+    }),
+    "recycler_assembler" : (recycler_assembler_loop, {
+        "assembler_modules_config", "items_quality_to_keep", "ingredients_quality_to_keep", "base_prod_bonus",
+        "recipe_ratio", "prod_module_bonus", "qual_module_bonus", "iterative", "accelerated"
+    }),
+}
+
+def solve_query(query : dict) -> np.ndarray:
+    """Solves a single query (see the module docstring for its format).
+
+    Raises:
+        ValueError: If the query is malformed, or if the loop never reaches a steady state.
+
+    Returns:
+        np.ndarray: What the solver of the loop returns.
+    """
+    if query.get("loop") not in LOOPS:
+        raise ValueError(f"Unknown loop {query.get('loop')!r}, expected one of {sorted(LOOPS)}")
+    if "input" not in query:
+        raise ValueError("Missing input")
+
+    solver, parameters = LOOPS[query["loop"]]
+    arguments = {key : value for key, value in query.items() if key not in ("id", "loop", "input", "model")}
+
+    unknown = set(arguments) - parameters
+    if unknown:
+        raise ValueError(f"Unknown parameters for the {query['loop']} loop: {sorted(unknown)}")
+
+    if "assembler_modules_config" in arguments:
+        # JSON has no tuples: [prod, qual] is one config for every tier, [[prod, qual], ...] is one config per tier
+        config = arguments["assembler_modules_config"]
+        arguments["assembler_modules_config"] = tuple(config) if np.ndim(config) == 1 else [tuple(modules) for modules in config]
+
+    model = QualityModel(**query["model"]) if "model" in query else DEFAULT_QUALITY_MODEL
+    input_vector = query["input"] if type(query["input"]) in (float, int) else np.array(query["input"], dtype=float)
+
+    return solver(input_vector, **arguments, model=model)
+
+def answer(line : str) -> str:
+    "Returns the JSON line that answers the query in `line`."
+    query = {}
+
+    try:
+        parsed = json.loads(line)
+        if type(parsed) != dict:
+            raise ValueError("A query must be a JSON object")
+        query = parsed
+
+        return json.dumps({"id" : query.get("id"), "result" : solve_query(query).tolist()})
+
+    except Exception as e: # e.g. the asserts the solvers validate their arguments with, or a division by zero
+        # One bad query must never take the rest of the batch (or the connection) down with it
+        return json.dumps({"id" : query.get("id"), "error" : f"{type(e).__name__}: {e}" if str(e) else type(e).__name__})
+
+def answer_all(lines : Iterable[str]) -> Iterator[str]:
+    "Answers every query in `lines`, skipping blank lines."
+    for line in lines:
+        if line.strip():
+            yield answer(line)
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    "Answers the JSON lines sent through a connection until it's closed."
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write(answer(line.decode()).encode() + b"\n")
+                self.wfile.flush()
+
+def serve(host : str = "localhost", port : int = 8765):
+    "Answers queries over TCP, one connection at a time, until interrupted. The caches stay warm between connections."
+    with socketserver.TCPServer((host, port), QueryHandler) as server:
+        print(f"Listening on {host}:{port}", file=sys.stderr)
+        server.serve_forever()
+
+def main(arguments : Union[list, None] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("queries", type=Path, nargs="?", help="JSON lines file with the queries. Defaults to stdin")
+    parser.add_argument("--server", action="store_true", help="Answer queries over TCP instead")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args(arguments)
+
+    if args.server:
+        serve(args.host, args.port)
+        return
+
+    with (args.queries.open() if args.queries else sys.stdin) as lines:
+        for result in answer_all(lines):
+            print(result, flush=True)
+
+if __name__ == "__main__":
+    main()
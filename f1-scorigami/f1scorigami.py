@@ -1,16 +1,45 @@
 # You'll need a data dump from https://github.com/jolpica/jolpica-f1 for this script to work
 
+import argparse
 import pandas as pd
 from pathlib import Path
 import duckdb
-from typing import List, Dict
-from numpy import nan
+from functools import lru_cache
+from typing import List
 import plotly.express as px
 import plotly.graph_objects as go
 
 CHARTS_PATH = Path(__file__).parent.parent / "Blog" / "static" / "charts"
 
-SESSION_ENTRIES_WITH_POINTS_AVAILABLE = duckdb.sql("""
+# The CSVs of the data dump are loaded once into a DuckDB database file, which every query reads from.
+# A table is only reloaded when its CSV is modified.
+DATABASE_PATH = Path("formula_one.duckdb")
+JOLPICA_TABLES = ["sessionentry", "roundentry", "round", "teamdriver", "driver", "team", "teamchampionship"]
+
+@lru_cache()
+def database() -> duckdb.DuckDBPyConnection:
+    "Returns a connection to the database with the data dump, (re)loading the tables whose CSV is newer than the database"
+    connection = duckdb.connect(str(DATABASE_PATH))
+    connection.sql("CREATE TABLE IF NOT EXISTS csv_mtimes (table_name VARCHAR PRIMARY KEY, mtime DOUBLE)")
+
+    loaded_mtimes = dict(connection.sql("SELECT table_name, mtime FROM csv_mtimes").fetchall())
+
+    for table in JOLPICA_TABLES:
+        table_name = f"formula_one_{table}"
+        csv_path = Path(f"{table_name}.csv")
+
+        if not csv_path.exists():
+            assert table_name in loaded_mtimes, f"Missing {csv_path}"
+            continue # Keep using the copy in the database
+
+        mtime = csv_path.stat().st_mtime
+        if loaded_mtimes.get(table_name) != mtime:
+            connection.sql(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM read_csv('{csv_path}')")
+            connection.execute("INSERT OR REPLACE INTO csv_mtimes VALUES (?, ?)", [table_name, mtime])
+
+    return connection
+
+SESSION_ENTRIES_WITH_POINTS_AVAILABLE_QUERY = """
     SELECT
         round.date,
         round.name AS grand_prix_name,
@@ -23,17 +52,17 @@ SESSION_ENTRIES_WITH_POINTS_AVAILABLE = duckdb.sql("""
 
         session_entry.points,
 
-    FROM 'formula_one_sessionentry.csv' AS session_entry
-    JOIN 'formula_one_roundentry.csv'   AS round_entry ON session_entry.round_entry_id = round_entry.id
-    JOIN 'formula_one_round.csv'        AS round       ON round_entry.round_id         = round.id
-    JOIN 'formula_one_teamdriver.csv'   AS team_driver ON round_entry.team_driver_id   = team_driver.id
-    JOIN 'formula_one_driver.csv'       AS driver      ON team_driver.driver_id        = driver.id
-    JOIN 'formula_one_team.csv'         AS team        ON team_driver.team_id          = team.id
+    FROM formula_one_sessionentry AS session_entry
+    JOIN formula_one_roundentry   AS round_entry ON session_entry.round_entry_id = round_entry.id
+    JOIN formula_one_round        AS round       ON round_entry.round_id         = round.id
+    JOIN formula_one_teamdriver   AS team_driver ON round_entry.team_driver_id   = team_driver.id
+    JOIN formula_one_driver       AS driver      ON team_driver.driver_id        = driver.id
+    JOIN formula_one_team         AS team        ON team_driver.team_id          = team.id
 
     WHERE NOT isnan(points)
 
     ORDER BY date
-""").df()
+"""
 
 OLD_TEAM_NAMES = {
     # Teams with stable branding
@@ -86,43 +115,125 @@ OLD_TEAM_NAMES = {
     ]
 }
 
+def team_name_intervals() -> pd.DataFrame:
+    "Flattens OLD_TEAM_NAMES into a table of (old_name, start_year, end_year, contemporary_team) rows. Open ended ranges end in 3000"
+    rows = []
+
+    for contemporary_team, old_name_ranges in OLD_TEAM_NAMES.items():
+        for old_name_range in old_name_ranges:
+            start, old_name, end = old_name_range if len(old_name_range) == 3 else (*old_name_range, 3000)
+            rows.append((old_name, start, end, contemporary_team))
+
+    df = pd.DataFrame(rows, columns=["old_name", "start_year", "end_year", "contemporary_team"])
+
+    # Every (team name, year) must map to a single contemporary team, or the join would duplicate rows
+    overlaps = df.reset_index().merge(df.reset_index(), on="old_name")
+    overlaps = overlaps[
+        (overlaps["index_x"] < overlaps["index_y"]) & # Every pair of different ranges, once
+        (overlaps["start_year_y"] <= overlaps["end_year_x"]) & (overlaps["start_year_x"] <= overlaps["end_year_y"])
+    ]
+    assert overlaps.empty, overlaps
+
+    return df
+
+TEAM_NAME_INTERVALS = team_name_intervals()
+
 def teams_in_f1_in(year : int) -> List[str]:
     "Returns the teams that were in F1 in a specific year"
-    return duckdb.sql(f"""
+    return database().sql(f"""
         SELECT team.name,
-        FROM 'formula_one_teamchampionship.csv' AS team_championship
-        JOIN 'formula_one_team.csv' AS team ON team_championship.team_id = team.id
+        FROM formula_one_teamchampionship AS team_championship
+        JOIN formula_one_team AS team ON team_championship.team_id = team.id
         WHERE team_championship.year = {year}
     """).df()["name"].unique().tolist()
 
-def sanity_check():
-    "Make sure the ranges in OLD_TEAM_NAMES are valid"
-    for year in range(1979, 2026):
-        teams = teams_in_f1_in(year)
+def sanity_check(first_year : int = 1979, last_year : int = 2025) -> pd.DataFrame:
+    """Make sure the ranges in OLD_TEAM_NAMES are valid: returns every (old name, year) covered by a range in which
+    no team with that name was in the championship. If the table isn't empty, we messed up our ranges"""
+    names = TEAM_NAME_INTERVALS
+
+    return database().sql(f"""
+        WITH teams_per_year AS (
+            SELECT DISTINCT team_championship.year, team.name,
+            FROM formula_one_teamchampionship AS team_championship
+            JOIN formula_one_team AS team ON team_championship.team_id = team.id
+        ),
+
+        expected_teams_per_year AS (
+            SELECT years.year, names.*,
+            FROM names
+            JOIN range({first_year}, {last_year} + 1) AS years(year) ON years.year BETWEEN names.start_year AND names.end_year
+        )
 
-        for old_names in OLD_TEAM_NAMES.values():
-            for old_name_range in old_names:
-                start, old_name, end = old_name_range if len(old_name_range) == 3 else (*old_name_range, 3000)
-                
-                if start <= year <= end:
-                    if old_name not in teams:
-                        print(year, old_name_range, teams) # If the code reaches here, we messed up our ranges
+        SELECT expected.year, expected.old_name, expected.start_year, expected.end_year, expected.contemporary_team,
+        FROM expected_teams_per_year AS expected
+        ANTI JOIN teams_per_year AS teams ON expected.year = teams.year AND expected.old_name = teams.name
+        ORDER BY expected.year, expected.contemporary_team, expected.old_name
+    """).df()
+
+def calculate_corrected_names(df : pd.DataFrame) -> pd.Series:
+    "For every row, if the team is still in the grid, return the current name. Otherwise return NaN"
+    rows = df[["date", "team_name"]].assign(row_id = range(len(df)))
+    names = TEAM_NAME_INTERVALS
+
+    corrected_names = duckdb.sql("""
+        SELECT names.contemporary_team,
+        FROM rows
+        LEFT JOIN names ON rows.team_name = names.old_name AND year(rows.date) BETWEEN names.start_year AND names.end_year
+        ORDER BY rows.row_id
+    """).df()["contemporary_team"]
+
+    return pd.Series(corrected_names.to_numpy(), index=df.index)
+
+def score_counts_pandas() -> pd.DataFrame:
+    "Calculates the points of every contemporary team in every round, along with their scorigami count, in pandas"
+    session_entries = database().sql(SESSION_ENTRIES_WITH_POINTS_AVAILABLE_QUERY).df()
+
+    points_per_team_per_round = session_entries.groupby(["date", "grand_prix_name", "team_name"])["points"].sum().reset_index()
+    points_per_team_per_round['current_team_name'] = calculate_corrected_names(points_per_team_per_round)
+
+    score_counts = points_per_team_per_round[points_per_team_per_round["current_team_name"].notna()].copy() # Remove all the teams that have not made it to present day
+    # A float sum depends on the order it's added up in: rounding makes it the same in both pipelines, so that a scorigami
+    # group is never split by a difference in the last bit
+    score_counts["points"] = score_counts["points"].round(2)
+    score_counts["points"] = score_counts["points"].replace(9.99, 10.0) # Here to fix a rounding error
+    score_counts["scorigami"] = calculate_scorigami(score_counts)
 
-def calculate_corrected_name(row):
-    "If the team is still in the grid, return the current name. Otherwise return NaN"
-    year, team = row["date"].year, row["team_name"]
+    return score_counts
 
-    if year == 2025 and row["grand_prix_name"] == "Abu Dhabi Grand Prix":
-        pass
+def score_counts_sql() -> pd.DataFrame:
+    """Same as `score_counts_pandas`, but the whole pipeline (joins, sums per round, name correction, rounding fix and scorigami count)
+    runs inside DuckDB: only the final table is turned into a dataframe"""
+    names = TEAM_NAME_INTERVALS
 
-    for contemporary_team, old_name_ranges in OLD_TEAM_NAMES.items():
-        for old_name_range in old_name_ranges:
-            start, old_name, end = old_name_range if len(old_name_range) == 3 else (*old_name_range, 3000)
+    return database().sql(f"""
+        WITH session_entries AS ({SESSION_ENTRIES_WITH_POINTS_AVAILABLE_QUERY}),
 
-            if team == old_name and start <= year <= end:
-                return contemporary_team
-    else:
-        return nan
+        points_per_team_per_round AS (
+            SELECT date, grand_prix_name, team_name, round(sum(points), 2) AS points, -- Same rounding as score_counts_pandas
+            FROM session_entries
+            GROUP BY date, grand_prix_name, team_name
+        ),
+
+        score_counts AS (
+            SELECT
+                round.date,
+                round.grand_prix_name,
+                round.team_name,
+                CASE WHEN round.points = 9.99 THEN 10.0 ELSE round.points END AS points, -- Here to fix a rounding error
+                names.contemporary_team AS current_team_name,
+
+            FROM points_per_team_per_round AS round
+            -- Removes all the teams that have not made it to present day
+            JOIN names ON round.team_name = names.old_name AND year(round.date) BETWEEN names.start_year AND names.end_year
+        )
+
+        SELECT
+            *,
+            row_number() OVER (PARTITION BY current_team_name, points ORDER BY date, grand_prix_name, team_name) AS scorigami,
+        FROM score_counts
+        ORDER BY date, grand_prix_name, team_name
+    """).df()
 
 def print_contemporary_teams_per_year_since_1979(points_per_contemporary_team_per_round : pd.DataFrame):
     teams_per_year = {}
@@ -138,23 +249,9 @@ def print_contemporary_teams_per_year_since_1979(points_per_contemporary_team_pe
     for year, teams in teams_per_year.items():
         print(f"{year}: {sorted(teams)}")
 
-def calculate_scorigami(df : pd.DataFrame) -> List[int]:
+def calculate_scorigami(df : pd.DataFrame) -> pd.Series:
     "Calculates the number of times a specific (team, point) combo has appeared up to that point, for every row in the table"
-    res = []
-
-    score_count : Dict[str, Dict[float, int]] = {}
-
-    for _, row in df.iterrows():
-        team, points = row["current_team_name"], row["points"]
-
-        if team not in score_count:
-            score_count[team] = {}
-        
-        count = score_count[team].get(points, 1)
-        res.append(count)
-        score_count[team][points] = count + 1
-
-    return res
+    return df.groupby(["current_team_name", "points"]).cumcount() + 1
 
 def save_as_plotly_html(df, name):
     fig = go.Figure(data=[go.Table(
@@ -383,12 +480,16 @@ def highscorigami(scorigami_df : pd.DataFrame):
     save_dataframe(df, "highscorigami", True)
 
 if __name__ == "__main__":
-    points_per_team_per_round = SESSION_ENTRIES_WITH_POINTS_AVAILABLE.groupby(["date", "grand_prix_name", "team_name"])["points"].sum().reset_index()
-    points_per_team_per_round['current_team_name'] = points_per_team_per_round.apply(calculate_corrected_name, axis=1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pipeline", choices=["sql", "pandas"], default="sql", help="Where to crunch the numbers. Defaults to sql (DuckDB)")
+    args = parser.parse_args()
 
-    score_counts = points_per_team_per_round[points_per_team_per_round["current_team_name"].notna()] # Remove all the teams that have not made it to present day
-    score_counts["points"] = score_counts["points"].replace(9.99, 10.0) # Here to fix a rounding error
-    score_counts["scorigami"] = calculate_scorigami(score_counts)
+    invalid_team_names = sanity_check()
+    if not invalid_team_names.empty:
+        print("Some ranges in OLD_TEAM_NAMES don't match the teams in the championship:")
+        print(invalid_team_names.to_string(index=False))
+
+    score_counts = score_counts_sql() if args.pipeline == "sql" else score_counts_pandas()
 
     scorigami_df = score_counts[score_counts["scorigami"] == 1]
     save_dataframe(score_counts, "score-counts")